@@ -114,6 +114,45 @@ STATICFILES_FINDERS = (
 
 #used by load_ds management command
 CACHE_HTTP_DATA = False
+# how the loaders store BiogpsDatasetData rows: 'json' keeps the legacy JSON
+# list, 'packed' keeps raw float bytes in DATASET_DATA_DTYPE.
+# existing rows can be converted with the pack_ds_data command. either way
+# the packed/dtype columns must exist, see "Upgrading an existing database"
+# in the README
+DATASET_DATA_STORAGE = 'packed'
+DATASET_DATA_DTYPE = '<f4'
+# directory holding one .npy matrix file per dataset, used for correlation.
+# existing DB matrices can be moved here with the export_ds_matrix command
+DATASET_MATRIX_DIR = os.path.join(BASE_DIR, 'matrix')
+# memory budget of the per-process cache of decoded dataset matrices
+MATRIX_CACHE_BYTES = 512 * 1024 * 1024
+# working memory for blockwise passes over a dataset matrix
+MATRIX_BLOCK_BYTES = 64 * 1024 * 1024
+# no. of top correlated partners kept per reporter by build_ds_neighbours
+NEIGHBOUR_TOP_N = 200
+# seconds correlation results are kept in the shared (memcached) cache
+CORRELATION_CACHE_TIMEOUT = 7 * 24 * 3600
+# gene -> reporter index, built from a mygene.info dump by build_gene_index
+GENE_INDEX_DB = os.path.join(BASE_DIR, 'gene_index.sqlite3')
+# gene -> miRNA reporters, converted from the gene2mirna shelve by
+# build_gene2mirna
+GENE2MIRNA_FILE = os.path.join(BASE_DIR, 'gene2mirna.json')
+# the shelve itself, read by the gene views while GENE2MIRNA_FILE is missing
+GENE2MIRNA_SHELVE = '/opt/biogps/gene2mirna_20170404.db'
+# seconds mygene.info gene documents are kept per process, and the window
+# concurrent misses are collected in for one getgenes call
+MYGENE_CACHE_TTL = 3600
+MYGENE_BATCH_WINDOW = 0.02
+# rendered dataset charts, least recently used ones are removed beyond the size
+CHART_CACHE_DIR = os.path.join(BASE_DIR, 'chart_cache')
+CHART_CACHE_BYTES = 1024 * 1024 * 1024
+# chart rendering worker processes (per web worker), charts queued before
+# answering 503, seconds a chart may take, charts a worker renders before
+# it is replaced
+CHART_RENDER_PROCESSES = 2
+CHART_RENDER_QUEUE = 8
+CHART_RENDER_TIMEOUT = 10
+CHART_RENDER_MAX_TASKS = 200
 #default gene id
 DEFAULT_GENE_ID = 1017
 
@@ -181,6 +220,8 @@ POPULAR_FACTORS = ['TREATMENT', 'GENOTYPE', 'CELL TYPE', 'AGE', 'CELL LINE', 'OR
                    'ClinicalInformation', 'KARYOTYPE', 'SAMPLE GROUP', 'ORIGIN', 'SUBTYPE', 'ClinicalTreatment', 'TRANSGENE']
 
 
+# correlation is refused above this no. of samples for matrices decoded
+# whole from the DB, memory-mapped matrices have no limit
 MAX_SAMPLE_4_CORRELATION = 400   # 200
 
 ES_INDEX_NAME = "biogps_ds"
@@ -65,6 +65,10 @@ MAX_SUPPORTED_SAMPLES = 50
 # we can not calculate its correlation
 MAX_SAMPLE_4_CORRELATION = 200
 
+# working memory for blockwise passes over a dataset matrix,
+# e.g. correlations of datasets with many samples
+MATRIX_BLOCK_BYTES = 64 * 1024 * 1024
+
 # keys for taging dataset
 NCBO_ANNO_KEY = 'xxxxxxx'
 # popular factors among all datasets
@@ -0,0 +1,403 @@
+'''
+Static bar charts of a reporter's values in a dataset (dataset_chart), and
+the disk cache of rendered charts under settings.CHART_CACHE_DIR.
+
+PNG charts are rendered by a small per-process pool of worker processes
+(chart_renderer) with matplotlib's object-oriented Agg API, away from the
+request threads; pyplot keeps global figures and is not thread-safe. SVG
+charts (render_svg) are written directly, without matplotlib.
+'''
+import hashlib
+import math
+import multiprocessing
+import os
+import tempfile
+import threading
+from io import BytesIO
+from xml.sax.saxutils import escape
+from django.conf import settings
+
+
+def chart_key(ds, reporter, group, collapse, name, fmt='png'):
+    """ cache key (and ETag) of a chart, changes with the dataset """
+    raw = '|'.join(str(e) for e in (ds.id, ds.lastmodified.isoformat(),
+                                    reporter, group, collapse, name, fmt))
+    return hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+class ChartCache(object):
+    """
+        rendered charts as files, least recently used ones are removed once
+        they take more than max_bytes. the size is checked every
+        check_every stores of this process, and by the warm_ds_charts
+        command
+    """
+
+    def __init__(self, path, max_bytes, check_every=100):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+        self._stores = 0
+        self._lock = threading.Lock()
+
+    def _file(self, key, ext):
+        return os.path.join(self.path, key[:2], key + ext)
+
+    def get(self, key, ext='.png'):
+        """ the stored chart, None if there is none """
+        path = self._file(key, ext)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            # mark as recently used for eviction
+            os.utime(path, None)
+        except OSError:
+            pass
+        return content
+
+    def put(self, key, content, ext='.png'):
+        path = self._file(key, ext)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        # a temp file of its own, other threads may store the same chart
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.chmod(tmp_path, 0o644)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        with self._lock:
+            self._stores += 1
+            check = self._stores % self.check_every == 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """ remove least recently used charts down to max_bytes """
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.path):
+            for fn in names:
+                path = os.path.join(root, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        files.sort()
+        removed = 0
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+chart_cache = ChartCache(settings.CHART_CACHE_DIR, settings.CHART_CACHE_BYTES)
+
+
+def find_round(v):
+    r = math.pow(10, round(math.log(v, 10))*-1+3)
+    return 10 if r < 10 else r
+
+
+def draw_median(ax, pos, length, label):
+    ax.plot([pos, pos], [0, length], '#960096', linewidth=0.5)
+    ax.text(pos, length, label, ha='center', va='bottom',
+            fontsize=7, color='#960096')
+
+
+def render_png(back):
+    """ PNG bar chart of back, the prepare_chart_data output """
+    import numpy as np
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    color_total = len(settings.BAR_COLORS)
+    vals, devs, colors, val_dev = [], [], [], []
+    for idx, e in enumerate(back):
+        vals.append(e['value'])
+        devs.append(e['dev'])
+        if e['value'] >= 0:
+            val_dev.append(e['value']+e['dev'])
+        else:
+            val_dev.append(e['value']-e['dev'])
+        colors.append(settings.BAR_COLORS[e['color_idx'] % color_total])
+
+    y_pos = np.arange(len(back))
+    # a figure of its own, nothing is registered with pyplot
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    fig.set_size_inches(15, len(back) * 0.14)
+    # draw bars
+    # bar width
+    width = 0.8
+    # only positive error bar
+    d_n = []
+    d_p = []
+    for idx, e in enumerate(vals):
+        if e > 0:
+            d_n.append(0)
+            d_p.append(devs[idx])
+        else:
+            d_p.append(0)
+            d_n.append(devs[idx])
+    ax.barh(y_pos, vals, width, color=colors, edgecolor='none',
+            xerr=[d_n, d_p], ecolor='#D2691E')
+    # eliminate top padding
+    ax.axis('tight')
+    # x axis range, have some padding space, and take standard dev into account
+    li = [max(val_dev), 0, min(val_dev)]
+    ax.set_xlim([min(li)*1.1, max(li)*1.1])
+
+    # x=0, draw y axis
+    ax.plot([0, 0], [0, len(back)], 'k', linewidth=0.5)
+    # draw median line and label
+    # M
+    median = np.median(vals)
+    rd = find_round(max(vals))
+    draw_median(ax, round(median*rd)/rd, len(back),
+                'M(%s)' % str(round(median*rd)/rd))
+    li = [max(vals), min(vals)]
+    # try Mx3
+    if median*3 < max(li) and median*3 > min(li):
+        draw_median(ax, round(median*3*rd)/rd, len(back), '3xM')
+    # try Mx10
+    if median*10 < max(li) and median*10 > min(li):
+        draw_median(ax, round(median*10*rd)/rd, len(back), '10xM')
+    # set ticks attributes
+    ax.tick_params(axis='x', which='both', bottom='off', top='off',
+                   labelsize=8)
+    ax.tick_params(axis='y', which='both', left='on', right='off',
+                   direction='out')
+    # draw y ticks and label
+    ax.set_yticks(y_pos + width / 2)
+    ax.set_yticklabels([e['name'] for e in back], fontsize=8)
+    # grid on x axis
+    ax.xaxis.grid(linestyle='-', color='#aaaaaa')
+
+    out = BytesIO()
+    fig.savefig(out, format='png', facecolor='w',
+                bbox_inches='tight', pad_inches=0.2)
+    return out.getvalue()
+
+
+# SVG layout, in pixels
+SVG_ROW = 14
+SVG_PLOT_WIDTH = 1200
+SVG_MARGIN = 24
+SVG_CHAR_WIDTH = 6
+
+
+def _nice_ticks(lo, hi, count=8):
+    """ round tick positions covering [lo, hi] """
+    span = hi - lo
+    step = math.pow(10, math.floor(math.log10(span / count)))
+    for m in (1, 2, 5, 10):
+        if span / (step * m) <= count:
+            step *= m
+            break
+    first = math.ceil(lo / step)
+    return [i * step for i in range(int(first), int(math.floor(hi / step)) + 1)]
+
+
+def render_svg(back):
+    """
+        SVG bar chart of back (the prepare_chart_data output), the layout
+        of render_png drawn directly
+    """
+    color_total = len(settings.BAR_COLORS)
+    vals = [e['value'] for e in back]
+    val_dev = [e['value'] + e['dev'] if e['value'] >= 0
+               else e['value'] - e['dev'] for e in back]
+    # x axis range, have some padding space, and take standard dev into account
+    li = [max(val_dev), 0, min(val_dev)]
+    x_min, x_max = min(li) * 1.1, max(li) * 1.1
+    if x_max == x_min:
+        x_max = x_min + 1
+    n = len(back)
+    label_w = max(len(e['name']) for e in back) * SVG_CHAR_WIDTH + 8
+    left = label_w
+    top = SVG_MARGIN
+    plot_h = n * SVG_ROW
+    width = left + SVG_PLOT_WIDTH + SVG_MARGIN
+    height = top + plot_h + SVG_MARGIN
+
+    def x(v):
+        return left + (v - x_min) / (x_max - x_min) * SVG_PLOT_WIDTH
+
+    def row_top(i):
+        # first element at the bottom, like barh
+        return top + (n - 1 - i) * SVG_ROW
+
+    out = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+           'font-family="sans-serif" font-size="10">' % (width, height),
+           '<rect width="100%" height="100%" fill="#ffffff"/>']
+    # grid and x labels
+    for t in _nice_ticks(x_min, x_max):
+        out.append('<line x1="%.1f" y1="%d" x2="%.1f" y2="%d" '
+                   'stroke="#aaaaaa" stroke-width="0.5"/>'
+                   % (x(t), top, x(t), top + plot_h))
+        out.append('<text x="%.1f" y="%d" text-anchor="middle">%s</text>'
+                   % (x(t), top + plot_h + 14, '%g' % (t + 0.0)))
+    bar_h = SVG_ROW * 0.8
+    for i, e in enumerate(back):
+        y = row_top(i) + (SVG_ROW - bar_h) / 2
+        x0, x1 = sorted((x(0), x(e['value'])))
+        color = settings.BAR_COLORS[e['color_idx'] % color_total]
+        out.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" '
+                   'fill="%s"/>' % (x0, y, x1 - x0, bar_h, color))
+        # only the error bar away from 0
+        if e['dev']:
+            end = e['value'] + e['dev'] if e['value'] > 0 \
+                else e['value'] - e['dev']
+            mid = y + bar_h / 2
+            out.append('<path d="M%.1f %.1fH%.1fM%.1f %.1fV%.1f" '
+                       'stroke="#D2691E" fill="none"/>'
+                       % (x(e['value']), mid, x(end), x(end), mid - 3,
+                          mid + 3))
+        out.append('<text x="%d" y="%.1f" text-anchor="end">%s</text>'
+                   % (left - 4, row_top(i) + SVG_ROW - 3,
+                      escape(str(e['name']))))
+    # x=0, draw y axis
+    out.append('<line x1="%.1f" y1="%d" x2="%.1f" y2="%d" stroke="#000000" '
+               'stroke-width="0.5"/>' % (x(0), top, x(0), top + plot_h))
+
+    # draw median line and label
+    def median_line(pos, label):
+        out.append('<line x1="%.1f" y1="%d" x2="%.1f" y2="%d" '
+                   'stroke="#960096" stroke-width="0.5"/>'
+                   % (x(pos), top, x(pos), top + plot_h))
+        out.append('<text x="%.1f" y="%d" text-anchor="middle" '
+                   'fill="#960096" font-size="9">%s</text>'
+                   % (x(pos), top - 3, escape(label)))
+    s_vals = sorted(vals)
+    half = len(s_vals) // 2
+    median = s_vals[half] if len(s_vals) % 2 \
+        else (s_vals[half - 1] + s_vals[half]) / 2.0
+    rd = find_round(max(vals))
+    median_line(round(median*rd)/rd, 'M(%s)' % str(round(median*rd)/rd))
+    li = [max(vals), min(vals)]
+    # try Mx3
+    if median*3 < max(li) and median*3 > min(li):
+        median_line(round(median*3*rd)/rd, '3xM')
+    # try Mx10
+    if median*10 < max(li) and median*10 > min(li):
+        median_line(round(median*10*rd)/rd, '10xM')
+    out.append('</svg>')
+    return '\n'.join(out).encode('utf-8')
+
+
+class ChartBusy(Exception):
+    """ the renderer has too many charts queued, or one took too long """
+
+
+class _RenderTask(object):
+    """
+        one chart queued on the renderer, holding a slot until finished:
+        rendered, failed, or dropped with its pool
+    """
+
+    def __init__(self):
+        self.finished = False
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ChartRenderer(object):
+    """
+        renders charts in a pool of worker processes, started on first use.
+        at most max_queued charts are queued or rendering at a time, more
+        raise ChartBusy right away, as does a chart not done in timeout
+        seconds; the pool is then terminated, so hung workers don't keep
+        their slots, the other charts queued on it fail at once, and a new
+        pool is started on the next chart. workers are replaced after
+        max_tasks charts
+    """
+
+    def __init__(self, processes, max_queued, timeout, max_tasks):
+        self.processes = processes
+        self.timeout = timeout
+        self.max_tasks = max_tasks
+        self._slots = threading.BoundedSemaphore(max_queued)
+        self._pool = None
+        # unfinished tasks of the current pool
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def _finish(self, task, value=None, error=None):
+        """ set the outcome of task and free its slot, only once """
+        with self._lock:
+            if task.finished:
+                return
+            task.finished = True
+            task.value, task.error = value, error
+            self._tasks.discard(task)
+        self._slots.release()
+        task.done.set()
+
+    def _reset(self, pool):
+        """ terminate pool and fail its unfinished charts """
+        with self._lock:
+            # another thread may have reset it already
+            if self._pool is not pool:
+                return
+            self._pool = None
+            tasks, self._tasks = self._tasks, set()
+        pool.terminate()
+        for task in tasks:
+            self._finish(task, error=ChartBusy('chart renderer restarted'))
+
+    def terminate(self):
+        """ stop the workers, a new pool is started on the next chart """
+        pool = self._pool
+        if pool is not None:
+            self._reset(pool)
+
+    def render(self, func, *args):
+        """ func(*args) run by a worker, e.g. render(render_png, back) """
+        if not self._slots.acquire(False):
+            raise ChartBusy('too many charts queued')
+        task = _RenderTask()
+        try:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = multiprocessing.Pool(
+                        self.processes, maxtasksperchild=self.max_tasks)
+                pool = self._pool
+                self._tasks.add(task)
+            pool.apply_async(
+                func, args,
+                callback=lambda value: self._finish(task, value=value),
+                error_callback=lambda error: self._finish(task, error=error))
+        except Exception as e:
+            self._finish(task, error=e)
+            raise
+        if not task.done.wait(self.timeout):
+            self._reset(pool)
+            raise ChartBusy('chart not rendered in %ss' % self.timeout)
+        if task.error is not None:
+            raise task.error
+        return task.value
+
+
+chart_renderer = ChartRenderer(settings.CHART_RENDER_PROCESSES,
+                               settings.CHART_RENDER_QUEUE,
+                               settings.CHART_RENDER_TIMEOUT,
+                               settings.CHART_RENDER_MAX_TASKS)
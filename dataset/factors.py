@@ -0,0 +1,180 @@
+'''
+Sample layouts of datasets by factor, and aggregation of sample values by
+layout: samples sharing an order_idx form a group, charted as one bar with
+the mean and standard deviation of its values.
+'''
+import numpy as np
+
+
+def get_sample_name_list(ds, from_factor=None):
+    names = []
+    for f in ds.metadata['factors']:
+        if from_factor is not None:
+            if from_factor in f[list(f)[0]]['factorvalue']:
+                name = f[list(f)[0]]['factorvalue'][from_factor]
+            else:
+                return []
+        else:
+            name = list(f)[0]
+        names.append(name)
+    return names
+
+
+def get_ds_factors(ds):
+    """
+        return factors in the order of ds.factors, ds.metadata['factors'] or []
+    """
+    # set to ds.factors if provided
+    factors = ds.factors or []
+    # otherwise, taking from ds.metadata if factorvalue is provided
+    if not factors and 'factors' in ds.metadata:
+        if 'factorvalue' in list(ds.metadata['factors'][0].values())[0]:
+            factors = [list(e.values())[0]['factorvalue'] for e in ds.metadata['factors']]
+    return factors
+
+
+def factor_layout(ds, group, collapse, naming):
+    """
+        sample layout of ds as returned by get_ds_factors_keys (uncached),
+        False where that returns None
+    """
+    factors = []
+    names = []
+    # factor value -> color index, in order of appearance
+    fvs = {}
+    if group is not None:
+        # for j, f in enumerate(ds.factors):
+        for j, f in enumerate(get_ds_factors(ds)):
+            # exception!
+            if group not in f:
+                return False
+            v = f[group]
+            color_idx = fvs.setdefault(v, len(fvs))
+            if collapse:
+                # label(name) switch does not support when collapse is true
+                names.append(v)
+            # set order just factor value, do real order at the end
+            order_idx = v
+            factors.append({'order_idx': order_idx, 'color_idx': color_idx})
+    else:
+        # no group, order by sequence or preset 'order_idx'
+        i = 1
+        for f in ds.metadata['factors']:
+            content = f[list(f)[0]]
+            if 'order_idx' in content and 'color_idx' in content:
+                order_idx = content['order_idx']
+                color_idx = content['color_idx']
+            # finally by index number
+            else:
+                color_idx = order_idx = i
+                i = i + 1
+            factors.append({'order_idx': order_idx, 'color_idx': color_idx})
+
+    if len(names) == 0:
+        names = get_sample_name_list(ds, naming)
+
+    for j, e in enumerate(factors):
+        e['name'] = names[j]
+
+    # sort samples by grouped name
+    if group:
+        rank = dict((v, idx) for idx, v in enumerate(sorted(fvs)))
+        t = {}
+        interval = len(ds.metadata['factors'])
+        for e in factors:
+            val = e['order_idx']
+            od = interval*rank[val]
+            if not collapse:
+                if val in t:
+                    t[val] += 1
+                    inc = t[val]
+                else:
+                    inc = t[val] = 0
+                od += inc
+            e['order_idx'] = od
+
+    return factors
+
+
+class FactorGroups(object):
+    """
+        groups of a factor layout, highest order_idx first. aggregates the
+        values of any no. of reporters at once
+    """
+
+    def __init__(self, factors):
+        # stable, so a group is represented by its first sample
+        self.perm = np.array(sorted(range(len(factors)),
+                                    key=lambda j: factors[j]['order_idx'],
+                                    reverse=True), dtype=np.intp)
+        order = [factors[j]['order_idx'] for j in self.perm]
+        self.starts = np.array([0] + [j for j in range(1, len(order))
+                                      if order[j] != order[j - 1]],
+                               dtype=np.intp)
+        self.counts = np.diff(np.append(self.starts, len(order)))
+        self.samples = []
+        for j in self.perm[self.starts]:
+            e = factors[j]
+            name = e['name']
+            # remove ' 1' surfix in element name only for samples starting with GSM, to match the biogps view
+            if name.startswith('GSM'):
+                name = name.rstrip(' 1')
+            else:
+                name = name.rstrip(' ')
+            self.samples.append({'order_idx': e['order_idx'],
+                                 'color_idx': e['color_idx'], 'name': name})
+
+    def aggregate(self, values):
+        """
+            (means, stds) of each group, values is reporters x samples in
+            layout order; both are reporters x groups
+        """
+        values = np.asarray(values, dtype=np.float64)[:, self.perm]
+        means = np.add.reduceat(values, self.starts, axis=1) / self.counts
+        dev = values - np.repeat(means, self.counts, axis=1)
+        stds = np.sqrt(np.add.reduceat(dev * dev, self.starts, axis=1) /
+                       self.counts)
+        return means, stds
+
+    def chart_data(self, means, stds):
+        """
+            chart elements of one reporter from its group means and stds:
+            a group of several samples gets its mean (2 decimals) and
+            standard deviation (3 decimals), a single sample its value
+        """
+        multi = self.counts > 1
+        values = np.where(multi, np.round(means, 2), means).tolist()
+        devs = np.round(stds, 3).tolist()
+        res = []
+        for e, is_multi, value, dev in zip(self.samples, multi.tolist(),
+                                           values, devs):
+            e = dict(e)
+            e['value'] = value
+            e['dev'] = dev if is_multi else 0
+            res.append(e)
+        return res
+
+    def chart_rows(self, values):
+        """ chart elements of each row of values (reporters x samples) """
+        means, stds = self.aggregate(values)
+        return [self.chart_data(m, s) for m, s in zip(means, stds)]
+
+
+def collapsed_groups(ds):
+    """
+        {factor: FactorGroups} of the collapsed layout of each factor of ds
+        with more than one value, the factors dataset_factors offers
+    """
+    values = {}
+    for fv in get_ds_factors(ds):
+        for f in fv:
+            values.setdefault(f, set()).add(fv[f])
+    groups = {}
+    for f in values:
+        if len(values[f]) < 2:
+            continue
+        layout = factor_layout(ds, f, True, None)
+        # some samples miss the factor
+        if layout is not False:
+            groups[f] = FactorGroups(layout)
+    return groups
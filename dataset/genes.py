@@ -0,0 +1,485 @@
+'''
+Gene -> reporter lookups. A local index built from a mygene.info dump by the
+build_gene_index command (SQLite, settings.GENE_INDEX_DB) is read first, so
+gene based views don't have to wait on the mygene.info API; what still goes
+to mygene.info is cached and batched by gene_docs.
+'''
+import json
+import logging
+import os
+import shelve
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import mygene
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from dataset import models
+
+# these are the fields reporters are taken from
+REPORTER_FIELDS = ['entrezgene', 'reporter', 'refseq.rna', 'ensembl.gene']
+
+
+def _get_flat_list(value):
+    """ flatten nested lists/dict values into a list of scalars """
+    if isinstance(value, dict):
+        value = list(value.values())
+    if not isinstance(value, list):
+        return [value]
+    out_list = []
+    for val in value:
+        out_list += _get_flat_list(val)
+    return out_list
+
+
+def reporters_from_doc(data_json):
+    """ reporters of a mygene.info gene document, e.g. from getgene """
+    reporters = []
+    for field in REPORTER_FIELDS:
+        field, _, subfield = field.partition('.')
+        if field not in data_json:
+            continue
+        _rep = data_json[field]
+        if subfield:
+            # nested field, e.g. refseq.rna, may be a list of objects
+            _rep = _rep if isinstance(_rep, list) else [_rep]
+            _rep = [x[subfield] for x in _rep
+                    if isinstance(x, dict) and subfield in x]
+        _rep = _get_flat_list(_rep)
+        if field == 'refseq':
+            _rep = [x.split('.')[0] for x in _rep]
+        reporters += _rep
+    return [str(x) for x in reporters]
+
+
+class GeneIndex(object):
+    """
+        read access to the SQLite gene index, one connection per thread.
+        a rebuilt index file is picked up within check_interval seconds
+    """
+
+    def __init__(self, path, check_interval=60):
+        self.path = path
+        self.check_interval = check_interval
+        self._local = threading.local()
+
+    def _connection(self):
+        local = self._local
+        now = time.time()
+        if getattr(local, 'checked', 0) + self.check_interval < now:
+            local.checked = now
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+            if mtime != getattr(local, 'mtime', None):
+                if getattr(local, 'conn', None) is not None:
+                    local.conn.close()
+                local.conn = None
+                if mtime is not None:
+                    local.conn = sqlite3.connect(
+                        'file:%s?mode=ro' % self.path, uri=True)
+                local.mtime = mtime
+        return local.conn
+
+    def lookup(self, gene):
+        """ (reporters, taxid) of gene, None if not in the index """
+        conn = self._connection()
+        if conn is None:
+            return None
+        row = conn.execute('SELECT reporters, taxid FROM gene WHERE gene = ?',
+                           (str(gene),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def iter_genes(self, taxid):
+        """ yield (gene, reporters) of the genes of taxid in the index """
+        conn = self._connection()
+        if conn is None:
+            return
+        for gene, reporters in conn.execute(
+                'SELECT gene, reporters FROM gene WHERE taxid = ?', (taxid,)):
+            yield gene, json.loads(reporters)
+
+
+gene_index = GeneIndex(settings.GENE_INDEX_DB)
+
+
+class GeneMirnaMap(object):
+    """
+        gene -> miRNA reporters, read once per process from the JSON file
+        written by build_gene2mirna. a changed file is reloaded within
+        check_interval seconds. while the file is missing the gene2mirna
+        shelve at shelve_path, if any, is read instead (once)
+    """
+
+    def __init__(self, path, shelve_path=None, check_interval=60):
+        self.path = path
+        self.shelve_path = shelve_path
+        self.check_interval = check_interval
+        self._map = {}
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        now = time.time()
+        if self._checked + self.check_interval >= now:
+            return
+        with self._lock:
+            if self._checked + self.check_interval >= now:
+                return
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+            # also on the first check, the file may have never existed
+            if mtime != self._mtime or not self._checked:
+                if mtime is not None:
+                    with open(self.path) as f:
+                        mapping = dict((gene, tuple(reps)) for gene, reps
+                                       in json.load(f).items())
+                else:
+                    mapping = self._read_shelve()
+                self._map = mapping
+                self._mtime = mtime
+            self._checked = now
+
+    def _read_shelve(self):
+        if not self.shelve_path or not os.path.exists(self.shelve_path):
+            logging.warning('%s is missing, genes get no miRNA reporters; '
+                            'run build_gene2mirna', self.path)
+            return {}
+        logging.warning('%s is missing, reading %s instead; run '
+                        'build_gene2mirna', self.path, self.shelve_path)
+        d = shelve.open(self.shelve_path, 'r')
+        try:
+            return dict((str(gene), tuple(str(x) for x in alwayslist(reps)))
+                        for gene, reps in d.items())
+        finally:
+            d.close()
+
+    def get(self, gene):
+        """ miRNA reporters of gene, an empty list if there are none """
+        self._refresh()
+        return list(self._map.get(str(gene), ()))
+
+
+gene_mirna = GeneMirnaMap(settings.GENE2MIRNA_FILE,
+                          settings.GENE2MIRNA_SHELVE)
+
+
+class _Batch(object):
+    """ genes fetched together by one getgenes call """
+
+    def __init__(self):
+        self.genes = []
+        self.docs = {}
+        self.error = None
+        self.done = threading.Event()
+
+
+class GeneDocCache(object):
+    """
+        mygene.info gene documents kept for ttl seconds. concurrent lookups
+        of a gene share one outbound call, and misses arriving within
+        batch_window seconds are fetched by one getgenes call. fields is a
+        superset of what the gene views need, so they share entries
+    """
+
+    def __init__(self, ttl, batch_window, fields, max_entries=10000):
+        self.ttl = ttl
+        self.batch_window = batch_window
+        self.fields = fields
+        self.max_entries = max_entries
+        self._docs = OrderedDict()
+        self._pending = {}
+        self._open = None
+        self._lock = threading.Lock()
+
+    def get(self, gene):
+        """ the gene document, None if mygene.info doesn't know the gene """
+        gene = str(gene)
+        leader = False
+        with self._lock:
+            hit = self._docs.get(gene)
+            if hit is not None and hit[0] > time.time():
+                return hit[1]
+            batch = self._pending.get(gene)
+            if batch is None:
+                if self._open is None:
+                    self._open = _Batch()
+                    leader = True
+                batch = self._open
+                batch.genes.append(gene)
+                self._pending[gene] = batch
+        if leader:
+            if self.batch_window:
+                time.sleep(self.batch_window)
+            with self._lock:
+                # later misses start a new batch
+                self._open = None
+            self._fetch(batch)
+        else:
+            batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return batch.docs.get(gene)
+
+    def _fetch(self, batch):
+        try:
+            mg = mygene.MyGeneInfo()
+            res = mg.getgenes(batch.genes, fields=self.fields, verbose=False)
+            for doc in res or []:
+                if not doc.get('notfound'):
+                    batch.docs.setdefault(str(doc['query']), doc)
+        except Exception as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                now = time.time()
+                if batch.error is None:
+                    for gene in batch.genes:
+                        self._docs.pop(gene, None)
+                        self._docs[gene] = (now + self.ttl,
+                                            batch.docs.get(gene))
+                # entries expire in insertion order
+                while self._docs:
+                    oldest = next(iter(self._docs.values()))
+                    if len(self._docs) <= self.max_entries and oldest[0] > now:
+                        break
+                    self._docs.popitem(last=False)
+                for gene in batch.genes:
+                    self._pending.pop(gene, None)
+            batch.done.set()
+
+
+gene_docs = GeneDocCache(settings.MYGENE_CACHE_TTL,
+                         settings.MYGENE_BATCH_WINDOW,
+                         REPORTER_FIELDS + ['taxid'])
+
+
+def alwayslist(value, tuple_as_single=False):
+    if value is None:
+        return []
+    if (tuple_as_single and isinstance(value, list)) or \
+       (not tuple_as_single and isinstance(value, (list, tuple))):
+        return value
+    else:
+        return [value]
+
+
+def write_gene_mirna(path, mapping):
+    """
+        write the gene -> miRNA reporters file read by gene_mirna, return
+        the no. of genes. mapping values may be a reporter or a list
+    """
+    data = dict((str(gene), [str(x) for x in alwayslist(reps)])
+                for gene, reps in mapping.items())
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.rename(tmp_path, path)
+    return len(data)
+
+
+def write_gene_index(path, docs):
+    """
+        build the gene index at path from an iterable of mygene.info gene
+        documents, return the no. of genes. written aside then renamed,
+        so readers never see a partial index
+    """
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('CREATE TABLE gene (gene TEXT PRIMARY KEY, '
+                 'taxid INTEGER, reporters TEXT)')
+    count = 0
+    rows = []
+    for doc in docs:
+        rows.append((str(doc['_id']), doc.get('taxid'),
+                     json.dumps(reporters_from_doc(doc))))
+        if len(rows) >= 10000:
+            conn.executemany('INSERT OR REPLACE INTO gene VALUES (?, ?, ?)',
+                             rows)
+            count += len(rows)
+            rows = []
+    conn.executemany('INSERT OR REPLACE INTO gene VALUES (?, ?, ?)', rows)
+    count += len(rows)
+    conn.commit()
+    conn.close()
+    os.rename(tmp_path, path)
+    return count
+
+
+def query_reporter_genes(reporters, species=None):
+    """
+        query mygene to get gene ids and symbols of reporters,
+        return {reporter: [(gene_id, symbol), ...]}
+    """
+    if not reporters:
+        return {}
+    mg = mygene.MyGeneInfo()
+    species = species or 'human,mouse,rat,pig'
+    res = mg.querymany(reporters, scopes='reporter, entrezgene, ensembl.gene',
+                       fields='symbol', species=species, verbose=False)
+    anno = {}
+    for i in res:
+        if 'notfound' in i:
+            gene_id, symbol = '', ''
+        else:
+            gene_id, symbol = i['_id'], i.get('symbol', '')
+        anno.setdefault(i['query'], []).append((gene_id, symbol))
+    return anno
+
+
+def annotate_platform(platform, reporters=None, refresh=False):
+    """
+        store gene ids and symbols of reporters (default: all reporters of
+        platform) not yet annotated, return the no. of reporters queried.
+        refresh drops the platform's annotation first
+    """
+    if reporters is None:
+        reporters = platform.reporters
+    if refresh:
+        platform.reporter_annotations.all().delete()
+    done = set(platform.reporter_annotations.values_list('reporter',
+                                                         flat=True))
+    todo = {}
+    for rep in reporters:
+        rep = str(rep)
+        if rep.lower() not in done:
+            todo.setdefault(rep.lower(), rep)
+    anno = query_reporter_genes(list(todo.values()),
+                                species=platform.species or None)
+    rows = []
+    for key, rep in todo.items():
+        for gene_id, symbol in set(anno.get(rep, [('', '')])):
+            rows.append(models.BiogpsDatasetReporterAnnotation(
+                platform=platform, reporter=key, gene_id=str(gene_id),
+                symbol=symbol))
+    with transaction.atomic():
+        models.BiogpsDatasetReporterAnnotation.objects.bulk_create(
+            rows, batch_size=1000)
+    return len(todo)
+
+
+class ReporterAnnotations(object):
+    """
+        annotation of a platform as {reporter: [(gene_id, symbol), ...]}
+        kept per process, reloaded when the platform's rows change
+    """
+
+    def __init__(self):
+        self._platforms = {}
+        self._lock = threading.Lock()
+
+    def get(self, platform_id):
+        qs = models.BiogpsDatasetReporterAnnotation.objects.filter(
+            platform_id=platform_id)
+        version = qs.aggregate(Max('id'))['id__max']
+        if version is None:
+            return {}
+        with self._lock:
+            cached = self._platforms.get(platform_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        anno = {}
+        for rep, gene_id, symbol in qs.values_list('reporter', 'gene_id',
+                                                   'symbol').iterator():
+            anno.setdefault(rep, []).append((gene_id, symbol))
+        with self._lock:
+            self._platforms[platform_id] = (version, anno)
+        return anno
+
+
+reporter_annotations = ReporterAnnotations()
+
+
+class PlatformReporters(object):
+    """
+        sorted, lower case reporter array of each platform, tells without a
+        DB query whether a dataset can have any of some reporters. the
+        last max_platforms used are kept per process. datasets with
+        reporters missing from their platform list (e.g. loaded locally)
+        are never filtered, whether the list covers a dataset is checked
+        once per dataset version
+    """
+
+    def __init__(self, max_platforms=64):
+        self.max_platforms = max_platforms
+        self._arrays = OrderedDict()
+        # dataset id -> (lastmodified, platform list covers its reporters)
+        self._covered = {}
+        self._lock = threading.Lock()
+
+    def _array(self, platform_id):
+        with self._lock:
+            arr = self._arrays.pop(platform_id, None)
+            if arr is not None:
+                self._arrays[platform_id] = arr
+                return arr
+        try:
+            reporters = models.BiogpsDatasetPlatform.objects\
+                .only('reporters').get(id=platform_id).reporters
+        except models.BiogpsDatasetPlatform.DoesNotExist:
+            reporters = []
+        arr = np.array(sorted(str(r).lower().encode('utf-8')
+                              for r in reporters or []), dtype=bytes)
+        with self._lock:
+            self._arrays[platform_id] = arr
+            while len(self._arrays) > self.max_platforms:
+                self._arrays.popitem(last=False)
+        return arr
+
+    @staticmethod
+    def _found(arr, reporters):
+        """ boolean array, True for each of reporters in arr """
+        keys = np.array([str(r).lower().encode('utf-8') for r in reporters],
+                        dtype=bytes)
+        pos = np.minimum(np.searchsorted(arr, keys), len(arr) - 1)
+        return arr[pos] == keys
+
+    def _covers(self, ds, arr):
+        """ True if arr holds every reporter of the matrix of ds """
+        with self._lock:
+            hit = self._covered.get(ds.id)
+        if hit is not None and hit[0] == ds.lastmodified:
+            return hit[1]
+        try:
+            reporters = models.BiogpsDatasetMatrix.objects\
+                .only('reporters').get(dataset=ds).reporters
+        except models.BiogpsDatasetMatrix.DoesNotExist:
+            # its reporters are unknown
+            covered = False
+        else:
+            covered = not reporters or bool(self._found(arr, reporters).all())
+        with self._lock:
+            self._covered[ds.id] = (ds.lastmodified, covered)
+        return covered
+
+    def may_contain(self, ds, reporters):
+        """
+            False if dataset ds has none of reporters; always True for
+            datasets without a platform, platforms without a reporter list
+            (e.g. RNA-seq), and datasets with reporters off their platform
+            list
+        """
+        if ds.platform_id is None:
+            return True
+        arr = self._array(ds.platform_id)
+        if not len(arr):
+            return True
+        if not reporters:
+            return False
+        if self._found(arr, reporters).any():
+            return True
+        return not self._covers(ds, arr)
+
+
+platform_reporters = PlatformReporters()
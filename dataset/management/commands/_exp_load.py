@@ -5,6 +5,7 @@ import requests_cache
 import zipfile
 from io import BytesIO as StringIO
 from dataset import models
+from dataset.genes import annotate_platform
 from django.core.exceptions import ObjectDoesNotExist
 
 requests_cache.install_cache('ds_cache')
@@ -70,6 +71,8 @@ class Platform(ResourceRequest):
         except ObjectDoesNotExist:
             self.platform = models.BiogpsDatasetPlatform.objects.\
                 create(platform=self.name, reporters=self.reporters)
+        # gene ids and symbols used to annotate correlation results
+        annotate_platform(self.platform)
 
 
 class ExperimentRaw(ResourceRequest):
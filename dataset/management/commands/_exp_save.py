@@ -1,8 +1,6 @@
 import logging
-import numpy as np
 from dataset import models
 from django.core.exceptions import ObjectDoesNotExist
-from io import BytesIO
 
 
 class ExperimentSave:
@@ -78,18 +76,13 @@ class ExperimentSave:
             factors=fvs)
         # dataset data
         datasetdata = []
-        for idx in self.data.index:
+        for idx, row in zip(self.data.index, self.data.values):
             datasetdata.append(models.BiogpsDatasetData(
-                dataset=ds, reporter=idx,
-                data=list(self.data.loc[idx, :].values)))
+                dataset=ds, reporter=idx, values=row))
         models.BiogpsDatasetData.objects.bulk_create(datasetdata)
-        # tmp file
-        s = BytesIO()
-        np.save(s, self.data.values)
-        s.seek(0)
         mat = models.BiogpsDatasetMatrix(
-            dataset=ds,
-            reporters=list(self.data.index), matrix=s.read())
+            dataset=ds, reporters=list(self.data.index))
+        mat.store(self.data.values)
         mat.save()
         # finish, mark as loaded
         models.BiogpsDatasetGeoLoaded.objects.create(
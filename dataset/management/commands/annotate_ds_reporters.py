@@ -0,0 +1,44 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+from dataset import models
+from dataset.genes import annotate_platform
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+
+class Command(BaseCommand):
+    help = 'Fill in the reporter annotation table (gene id, symbol) of ' \
+           'platforms, used to annotate correlation results.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-p", "--platform", action="store", type="string",
+                    dest="platform",
+                    help='Only annotate this platform (id or name).'),
+        make_option("-r", "--refresh", action="store_true",
+                    dest="refresh", default=False,
+                    help='Drop and rebuild existing annotations.'),
+    )
+
+    def handle(self, *args, **options):
+        # turn off debug to limit memory usage
+        settings.DEBUG = False
+        platforms = models.BiogpsDatasetPlatform.objects.all().order_by('id')
+        if options['platform'] is not None:
+            try:
+                platforms = platforms.filter(id=int(options['platform']))
+            except ValueError:
+                platforms = platforms.filter(platform=options['platform'])
+
+        for pf_id in platforms.values_list('id', flat=True):
+            # one at a time, reporter lists can be large
+            pf = models.BiogpsDatasetPlatform.objects.get(id=pf_id)
+            reporters = set(pf.reporters)
+            # reporters of (e.g. locally loaded) datasets missing from the
+            # platform list
+            for mat in models.BiogpsDatasetMatrix.objects.filter(
+                    dataset__platform=pf).only('reporters').iterator():
+                reporters.update(mat.reporters)
+            count = annotate_platform(pf, reporters=reporters,
+                                      refresh=options['refresh'])
+            print('{}: annotated {} reporters'.format(pf.platform, count))
+        print('done')
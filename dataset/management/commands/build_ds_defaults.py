@@ -0,0 +1,81 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+from dataset import models
+from dataset.genes import gene_index, gene_mirna
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import transaction
+
+
+class Command(BaseCommand):
+    help = 'Build the gene -> default dataset table answering the ' \
+           'dataset default view, from the gene index and dataset data.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-t", "--taxid", action="store", type="int",
+                    dest="taxid",
+                    help='Only build genes of this taxid.'),
+    )
+
+    def handle(self, *args, **options):
+        # turn off debug to limit memory usage
+        settings.DEBUG = False
+        taxids = sorted(settings.TAXONOMY_MAPPING)
+        if options['taxid'] is not None:
+            taxids = [options['taxid']]
+        for taxid in taxids:
+            genes = {}
+            for gene, reporters in gene_index.iter_genes(taxid):
+                genes[gene] = set(reporters + gene_mirna.get(gene))
+            if not genes:
+                continue
+            defaults = self.resolve(taxid, genes)
+            rows = [models.BiogpsDatasetGeneDefault(
+                gene_id=gene, taxid=taxid, dataset_id=defaults.get(gene))
+                for gene in genes]
+            with transaction.atomic():
+                models.BiogpsDatasetGeneDefault.objects.filter(
+                    taxid=taxid).delete()
+                models.BiogpsDatasetGeneDefault.objects.bulk_create(
+                    rows, batch_size=1000)
+            print('{}: {} genes, {} with a default dataset'.format(
+                taxid, len(genes), len(defaults)))
+        print('done')
+
+    def candidates(self, taxid):
+        """
+            datasets of the species of taxid in the order a default is
+            picked: settings.DEFAULT_DATASET_MAPPING, then is_default ones
+        """
+        species = settings.TAXONOMY_MAPPING[taxid]
+        mapped = settings.DEFAULT_DATASET_MAPPING.get(taxid, '').lower()
+        datasets = models.BiogpsDataset.objects.filter(
+            platform__species=species).values_list('id', 'geo_gse_id',
+                                                   'is_default')
+        return [ds_id for ds_id, geo_gse_id, is_default in
+                sorted(datasets, key=lambda d: (d[1].lower() != mapped,
+                                                not d[2], d[0]))]
+
+    def resolve(self, taxid, genes):
+        """ {gene: dataset id} of the first candidate with data of gene """
+        rep_genes = {}
+        for gene, reporters in genes.items():
+            for rep in reporters:
+                rep_genes.setdefault(rep, set()).add(gene)
+        defaults = {}
+        for ds_id in self.candidates(taxid):
+            if not rep_genes:
+                break
+            ds_reporters = models.BiogpsDatasetData.objects.filter(
+                dataset_id=ds_id).values_list('reporter', flat=True)
+            found = set()
+            for rep in rep_genes.keys() & set(ds_reporters):
+                found |= rep_genes[rep]
+            for gene in found:
+                defaults[gene] = ds_id
+                # resolved, its other reporters don't count any more
+                for rep in genes[gene]:
+                    rep_genes.get(rep, set()).discard(gene)
+                    if rep in rep_genes and not rep_genes[rep]:
+                        del rep_genes[rep]
+        return defaults
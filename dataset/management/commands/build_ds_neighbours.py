@@ -0,0 +1,76 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+from multiprocessing import Pool
+import time
+from dataset import models
+from dataset import matrix as matrix_store
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import connections
+
+
+def build_neighbours(args):
+    """ worker: build the neighbour table of one matrix file """
+    ds_id, name, top_n = args
+    t0 = time.time()
+    try:
+        matrix_store.write_neighbours(name, top_n)
+    except Exception as e:
+        return ds_id, 'failed, %s' % e
+    return ds_id, 'done in %.1fs' % (time.time() - t0)
+
+
+class Command(BaseCommand):
+    help = 'Precompute the top correlated reporters of every reporter, per ' \
+           'dataset, served by the correlation view.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--dataset", action="store", type="string",
+                    dest="dataset",
+                    help='Only build this dataset (id or geo_gse_id).'),
+        make_option("-n", "--top", action="store", type="int",
+                    dest="top", default=None,
+                    help='Partners kept per reporter, default '
+                         'settings.NEIGHBOUR_TOP_N.'),
+        make_option("-p", "--processes", action="store", type="int",
+                    dest="processes", default=None,
+                    help='Worker processes, default one per CPU.'),
+        make_option("-f", "--force", action="store_true",
+                    dest="force", default=False,
+                    help='Rebuild tables that are already up to date.'),
+    )
+
+    def handle(self, *args, **options):
+        # turn off debug to limit memory usage
+        settings.DEBUG = False
+        top_n = options['top'] or settings.NEIGHBOUR_TOP_N
+        qs = models.BiogpsDatasetMatrix.objects.all().order_by('dataset')
+        if options['dataset'] is not None:
+            try:
+                qs = qs.filter(dataset_id=int(options['dataset']))
+            except ValueError:
+                qs = qs.filter(dataset__geo_gse_id=options['dataset'])
+
+        jobs = []
+        for ds_id, name in qs.values_list('dataset_id', 'path'):
+            if not name:
+                print('{}: matrix not exported, run export_ds_matrix '
+                      'first'.format(ds_id))
+                continue
+            # restartable, datasets finished by an earlier run are skipped
+            if not options['force'] and matrix_store.neighbours_fresh(name):
+                continue
+            jobs.append((ds_id, name, top_n))
+        print('{} datasets to build'.format(len(jobs)))
+        if not jobs:
+            return
+
+        # workers only touch matrix files, don't share the DB connection
+        connections.close_all()
+        pool = Pool(options['processes'])
+        try:
+            for ds_id, msg in pool.imap_unordered(build_neighbours, jobs):
+                print('{}: {}'.format(ds_id, msg))
+        finally:
+            pool.close()
+            pool.join()
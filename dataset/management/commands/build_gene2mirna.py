@@ -0,0 +1,31 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+import shelve
+from dataset import genes
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+
+class Command(BaseCommand):
+    help = 'Convert the gene2mirna shelve to the file read by gene views.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-i", "--input", action="store", type="string",
+                    dest="input",
+                    default=None,
+                    help='gene2mirna shelve, default '
+                         'settings.GENE2MIRNA_SHELVE.'),
+        make_option("-o", "--output", action="store", type="string",
+                    dest="output", default=None,
+                    help='Output file, default settings.GENE2MIRNA_FILE.'),
+    )
+
+    def handle(self, *args, **options):
+        output = options['output'] or settings.GENE2MIRNA_FILE
+        d = shelve.open(options['input'] or settings.GENE2MIRNA_SHELVE, 'r')
+        try:
+            count = genes.write_gene_mirna(output, d)
+        finally:
+            d.close()
+        print('done, wrote miRNA reporters of {} genes to {}'.format(
+            count, output))
@@ -0,0 +1,38 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+import gzip
+import json
+from dataset import genes
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+
+def read_docs(path):
+    """ gene documents of a mygene.info dump, one JSON document per line """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+class Command(BaseCommand):
+    help = 'Build the local gene -> reporter index from a mygene.info dump.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-i", "--input", action="store", type="string",
+                    dest="input",
+                    help='mygene.info gene dump, JSON lines, may be gzipped.'),
+        make_option("-o", "--output", action="store", type="string",
+                    dest="output", default=None,
+                    help='Index file, default settings.GENE_INDEX_DB.'),
+    )
+
+    def handle(self, *args, **options):
+        if options['input'] is None:
+            print('a mygene.info dump is required, see --help')
+            return
+        output = options['output'] or settings.GENE_INDEX_DB
+        count = genes.write_gene_index(output, read_docs(options['input']))
+        print('done, indexed {} genes in {}'.format(count, output))
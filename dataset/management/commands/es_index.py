@@ -80,8 +80,10 @@ class Command(BaseCommand):
             requests.post(plt_url, data=data)
             plt_count = plt_count + 1
             # temp_data中的default字段表面了该document来自那个数据库，整数1表明来自默认数据库
-            for ds in item.dataset_platform.all():
-                temp_data = ds.es_index_serialize()
+            datasets = list(item.dataset_platform.all())
+            tags = models.dataset_tags(datasets)
+            for ds in datasets:
+                temp_data = ds.es_index_serialize(tags=tags[ds.id])
                 data = json.dumps(temp_data)
                 url = settings.ES_URLS['DS'] + \
                     str(ds.id) + "?parent=" + str(plt_id)
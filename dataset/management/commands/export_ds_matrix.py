@@ -0,0 +1,84 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+from dataset import models
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+
+class Command(BaseCommand):
+    help = 'Export BiogpsDatasetMatrix blobs to the on-disk matrix store.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--dataset", action="store", type="string",
+                    dest="dataset",
+                    help='Only export this dataset (id or geo_gse_id).'),
+        make_option("-k", "--keep-blob", action="store_true",
+                    dest="keep_blob", default=False,
+                    help='Keep the base64 matrix in the DB after export. '
+                         'Use it unless every web host has the file.'),
+        make_option("-r", "--rebuild", action="store_true",
+                    dest="rebuild", default=False,
+                    help='Rewrite the derived files (normalised and '
+                         'ranked rows, group stats) of already exported '
+                         'matrices.'),
+        make_option("-v", "--verify", action="store_true",
+                    dest="verify", default=False,
+                    help='Only check exported files against checksums.'),
+    )
+
+    def handle(self, *args, **options):
+        # turn off debug to limit memory usage
+        settings.DEBUG = False
+        qs = models.BiogpsDatasetMatrix.objects.all().order_by('id')
+        if options['dataset'] is not None:
+            try:
+                qs = qs.filter(dataset_id=int(options['dataset']))
+            except ValueError:
+                qs = qs.filter(dataset__geo_gse_id=options['dataset'])
+
+        if options['verify']:
+            bad = 0
+            for mat in qs.exclude(path='').defer('_matrix').iterator():
+                if not mat.verify():
+                    print('{}: checksum mismatch or missing file {}'.format(
+                        mat.dataset_id, mat.path))
+                    bad += 1
+            print('done, {} bad matrix files'.format(bad))
+            return
+
+        if options['rebuild']:
+            count = 0
+            for mat in qs.exclude(path='').defer('_matrix').iterator():
+                mat.build_derived()
+                count += 1
+            print('done, rebuilt derived files of {} matrices'.format(count))
+            return
+
+        count = 0
+        # matrices never exported, and those exported on another host (the
+        # loaders write files where they run), are missing from this store
+        to_export = [mat.id for mat in qs.defer('_matrix', 'reporters')
+                     .iterator() if not mat.has_file()]
+        for mat_id in to_export:
+            # one at a time, each blob can be tens of MB
+            mat = models.BiogpsDatasetMatrix.objects.get(id=mat_id)
+            if not mat._matrix:
+                print('{}: no matrix file and no DB copy, reload the '
+                      'dataset'.format(mat.dataset_id))
+                continue
+            data = mat.load()
+            # the blob is only dropped from the DB if saved below
+            mat.store(data, keep_blob=False)
+            exported = mat.load()
+            if exported.shape != data.shape or \
+               exported.tobytes() != data.tobytes():
+                print('{}: exported file differs, skipped'.format(
+                    mat.dataset_id))
+                continue
+            fields = ['path', 'checksum']
+            if not options['keep_blob']:
+                fields.append('_matrix')
+            mat.save(update_fields=fields)
+            print('{}: exported to {}'.format(mat.dataset_id, mat.path))
+            count += 1
+        print('done, exported {} matrices'.format(count))
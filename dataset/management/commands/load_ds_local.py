@@ -1,10 +1,8 @@
 # -*-coding: utf-8 -*-
-from io import BytesIO
-
 import pandas as pd
-import numpy as np
 
 from dataset import models
+from dataset.genes import annotate_platform
 from django.core.management.base import BaseCommand
 from optparse import make_option
 
@@ -296,22 +294,22 @@ class Command(BaseCommand):
 
             dataframe = pd.read_csv(rnaseq_data, index_col=0, sep='\t')
             datasetdata = []
-            for idx in dataframe.index:
+            for idx, row in zip(dataframe.index, dataframe.values):
                 datasetdata.append(models.BiogpsDatasetData(dataset=dataset,
                                                             reporter=idx,
-                                                            data=dataframe.loc[idx, :].values.tolist()))
+                                                            values=row))
 
             # create all the individual **DATA** items (BiogpsDatasetData)
             models.BiogpsDatasetData.objects.bulk_create(datasetdata)
             # create and save the **MATRIX** (BiogpsDatasetMatrix)
-            # tmp file
-            s = BytesIO()
-            np.save(s, dataframe.values)
-            s.seek(0)
             matrix = models.BiogpsDatasetMatrix(dataset=dataset,
-                                                reporters=[str(i) for i in dataframe.index.tolist()],
-                                                matrix=s.read())
+                                                reporters=[str(i) for i in dataframe.index.tolist()])
+            matrix.store(dataframe.values)
             matrix.save()
+            # gene ids and symbols used to annotate correlation results
+            count = annotate_platform(dataset.platform,
+                                      reporters=matrix.reporters)
+            print('STEP 4: annotated {} new reporters'.format(count))
             get_random_test_genes = models.BiogpsDatasetData.objects.filter(dataset=dataset)[0:5]
             print('STEP 4: test url: ' + 'http://localhost:8000/static/data_chart.html?gene=' +
                   str(get_random_test_genes[0].reporter) + '&dataset=' + str(dataset.geo_gse_id))
@@ -0,0 +1,57 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+from dataset import models
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from django.db import transaction
+
+
+class Command(BaseCommand):
+    help = 'Convert JSON BiogpsDatasetData rows to packed float storage.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--dataset", action="store", type="string",
+                    dest="dataset",
+                    help='Only convert this dataset (id or geo_gse_id).'),
+        make_option("-t", "--dtype", action="store", type="string",
+                    dest="dtype", default=None,
+                    help='Packed dtype, default settings.DATASET_DATA_DTYPE.'),
+        make_option("-b", "--batch", action="store", type="int",
+                    dest="batch", default=1000,
+                    help='Rows converted per transaction, default 1000.'),
+    )
+
+    def handle(self, *args, **options):
+        # turn off debug to limit memory usage
+        settings.DEBUG = False
+        datasets = models.BiogpsDataset.objects.all().order_by('id')
+        if options['dataset'] is not None:
+            try:
+                ds_filter = {'id': int(options['dataset'])}
+            except ValueError:
+                ds_filter = {'geo_gse_id': options['dataset']}
+            datasets = datasets.filter(**ds_filter)
+
+        row_total = 0
+        for ds_id, geo_gse_id in datasets.values_list('id', 'geo_gse_id'):
+            count = self.pack_dataset(ds_id, options['dtype'],
+                                      options['batch'])
+            if count:
+                print('{}: packed {} rows'.format(geo_gse_id, count))
+            row_total += count
+        print('done, packed {} rows'.format(row_total))
+
+    def pack_dataset(self, ds_id, dtype, batch):
+        count = 0
+        qs = models.BiogpsDatasetData.objects.filter(
+            dataset_id=ds_id, _packed__isnull=True).order_by('id')
+        while True:
+            # packed rows drop out of the queryset, so always take the head
+            rows = list(qs[:batch])
+            if not rows:
+                return count
+            with transaction.atomic():
+                for row in rows:
+                    row.pack(dtype=dtype)
+                    row.save(update_fields=['data', '_packed', 'dtype'])
+            count += len(rows)
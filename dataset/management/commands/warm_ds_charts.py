@@ -0,0 +1,63 @@
+# -*-coding: utf-8 -*-
+from optparse import make_option
+from dataset.charts import chart_cache, chart_key, render_png
+from dataset.util import to_float_list
+from dataset.views import adopt_dataset, get_dataset_data, \
+    get_ds_factors_keys, prepare_chart_data
+from django.core.management.base import BaseCommand
+from django.conf import settings
+
+
+class Command(BaseCommand):
+    help = 'Pre-render dataset charts (default display options) into the ' \
+           'chart cache, for the default datasets and the given genes.'
+
+    option_list = BaseCommand.option_list + (
+        make_option("-d", "--dataset", action="append", type="string",
+                    dest="datasets",
+                    help='Dataset to render (id or geo_gse_id), may be '
+                         'repeated. Default: settings.DEFAULT_DATASET_MAPPING.'),
+        make_option("-g", "--genes", action="store", type="string",
+                    dest="genes",
+                    help='Comma separated gene ids, default '
+                         'settings.DEFAULT_GENE_ID.'),
+        make_option("-f", "--gene-file", action="store", type="string",
+                    dest="gene_file",
+                    help='File of gene ids, one per line, e.g. the most '
+                         'requested genes from the access logs.'),
+    )
+
+    def handle(self, *args, **options):
+        # turn off debug to limit memory usage
+        settings.DEBUG = False
+        datasets = options['datasets'] or \
+            sorted(settings.DEFAULT_DATASET_MAPPING.values())
+        genes = []
+        if options['genes']:
+            genes += [g.strip() for g in options['genes'].split(',')]
+        if options['gene_file']:
+            with open(options['gene_file']) as f:
+                genes += [line.strip() for line in f if line.strip()]
+        if not genes:
+            genes = [str(settings.DEFAULT_GENE_ID)]
+
+        count = 0
+        for ds_id in datasets:
+            ds = adopt_dataset(ds_id)
+            if ds is None:
+                print('{}: dataset not found'.format(ds_id))
+                continue
+            factors = get_ds_factors_keys(ds)
+            for gene in genes:
+                for item in get_dataset_data(ds, gene_id=gene)['data']:
+                    reporter = list(item)[0]
+                    key = chart_key(ds, reporter, None, False, None)
+                    if chart_cache.get(key) is not None:
+                        continue
+                    back = prepare_chart_data(
+                        to_float_list(item[reporter]['values']), factors)
+                    chart_cache.put(key, render_png(back))
+                    count += 1
+            print('{}: done'.format(ds_id))
+        removed = chart_cache.evict()
+        print('done, rendered {} charts, evicted {}'.format(count, removed))
@@ -0,0 +1,482 @@
+'''
+File based store for dataset matrices. Each dataset matrix is kept as one
+.npy file under settings.DATASET_MATRIX_DIR and is memory-mapped on read, so
+a request only pages in the rows it touches.
+
+Next to each matrix file the store keeps derived "sidecar" files, e.g.
+<ds_id>.norm.npy, the rows centred and scaled to unit norm in float32 so a
+Pearson correlation is a single matrix-vector product, and <ds_id>.rank.npy,
+the same for the rows' ranks, for Spearman correlation. <ds_id>.groups.json
+indexes the group mean and standard deviation matrices of the dataset's
+factors (<ds_id>.group<k>.mean.npy / .std.npy) served to collapsed charts.
+
+Decoded matrices are kept in a process-wide LRU cache (matrix_cache) bounded
+by settings.MATRIX_CACHE_BYTES.
+'''
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from django.conf import settings
+
+
+def matrix_file_path(name):
+    return os.path.join(settings.DATASET_MATRIX_DIR, name)
+
+
+def file_checksum(path):
+    """ md5 hex digest of a file, read in chunks """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def write_matrix_file(ds_id, data):
+    """
+        save data as <ds_id>.npy in the matrix store,
+        return (file name, checksum)
+    """
+    if not os.path.exists(settings.DATASET_MATRIX_DIR):
+        os.makedirs(settings.DATASET_MATRIX_DIR)
+    name = '{}.npy'.format(ds_id)
+    path = matrix_file_path(name)
+    # write aside and rename, readers holding the old map keep a valid file
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(data))
+    os.rename(tmp_path, path)
+    return name, file_checksum(path)
+
+
+def open_matrix_file(name):
+    """ memory-map a matrix file read-only """
+    return np.load(matrix_file_path(name), mmap_mode='r')
+
+
+def sidecar_name(name, kind, ext='.npy'):
+    """ e.g. sidecar_name('12.npy', 'norm') -> '12.norm.npy' """
+    return '{}.{}{}'.format(os.path.splitext(name)[0], kind, ext)
+
+
+def open_sidecar(name, kind):
+    """ memory-map a derived .npy file of matrix name, None if missing """
+    path = matrix_file_path(sidecar_name(name, kind))
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def normalise_rows(block):
+    """
+        rows of block centred and scaled to unit norm in float32, so the
+        dot product of two of them is their Pearson r. constant rows become
+        NaN and correlate as NaN, like numpy's pearsonr
+    """
+    block = np.asarray(block, dtype=np.float64)
+    centred = block - block.mean(axis=1)[:, np.newaxis]
+    norms = np.sqrt(np.einsum('ij,ij->i', centred, centred))
+    inv_norms = np.full(norms.shape, np.nan)
+    np.divide(1.0, norms, out=inv_norms, where=norms > 0)
+    centred *= inv_norms[:, np.newaxis]
+    return centred.astype(np.float32)
+
+
+def rank_rows(block):
+    """
+        replace the values of each row by their ranks, ties get their
+        average rank. Pearson r of ranked rows is the Spearman rho
+    """
+    import pandas as pd
+    return pd.DataFrame(np.asarray(block, dtype=np.float64)).rank(axis=1).values
+
+
+def spearman_rows(block):
+    """ normalised ranked rows, the dot product of two is their Spearman rho """
+    return normalise_rows(rank_rows(block))
+
+
+def _write_normalised(name, data, kind, transform=None):
+    """
+        write the normalised rows of data (transformed first, if given) as
+        sidecar kind of matrix name. rows are processed in blocks to bound
+        memory on large datasets
+    """
+    n_rows = data.shape[0]
+    block_rows = max(1, settings.MATRIX_BLOCK_BYTES // (8 * max(1, data.shape[1])))
+    path = matrix_file_path(sidecar_name(name, kind))
+    tmp_path = path + '.tmp'
+    normed = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                       dtype=np.float32, shape=data.shape)
+    for start in range(0, n_rows, block_rows):
+        stop = start + block_rows
+        block = data[start:stop]
+        if transform is not None:
+            block = transform(block)
+        normed[start:stop] = normalise_rows(block)
+    normed.flush()
+    del normed
+    os.rename(tmp_path, path)
+
+
+def write_normalised_rows(name, data):
+    """
+        write the normalised matrix <ds_id>.norm.npy for matrix file name,
+        for Pearson correlation
+    """
+    _write_normalised(name, data, 'norm')
+
+
+def write_rank_matrix(name, data):
+    """
+        write the normalised, rank transformed matrix <ds_id>.rank.npy for
+        matrix file name, for Spearman correlation
+    """
+    _write_normalised(name, data, 'rank', rank_rows)
+
+
+def neighbours_fresh(name):
+    """ True if the neighbour table of matrix name is newer than its rows """
+    norm_path = matrix_file_path(sidecar_name(name, 'norm'))
+    if not os.path.exists(norm_path):
+        return False
+    for kind in ('nbr_rows', 'nbr_values'):
+        path = matrix_file_path(sidecar_name(name, kind))
+        if not os.path.exists(path) or \
+           os.path.getmtime(path) < os.path.getmtime(norm_path):
+            return False
+    return True
+
+
+def write_neighbours(name, top_n):
+    """
+        write the coexpression neighbour table of matrix name: for each row,
+        its top_n best correlated rows (itself included) in
+        <ds_id>.nbr_rows.npy and their Pearson r in <ds_id>.nbr_values.npy,
+        best first. correlations are computed by row blocks of the
+        normalised matrix, each block of them takes
+        settings.MATRIX_BLOCK_BYTES; with the negated copy, the int64
+        argpartition indices and the NaN mask a block needs about 4 times
+        that
+    """
+    normed = open_sidecar(name, 'norm')
+    if normed is None:
+        write_normalised_rows(name, open_matrix_file(name))
+        normed = open_sidecar(name, 'norm')
+    n_rows = normed.shape[0]
+    top_n = min(top_n, n_rows)
+    block_rows = max(1, settings.MATRIX_BLOCK_BYTES // (4 * n_rows))
+    nbr_rows = np.empty((n_rows, top_n), dtype=np.int32)
+    nbr_values = np.empty((n_rows, top_n), dtype=np.float32)
+    for start in range(0, n_rows, block_rows):
+        corrs = np.dot(normed[start:start + block_rows], normed.T)
+        # constant rows correlate as NaN, rank them last
+        corrs[np.isnan(corrs)] = -np.inf
+        pos = np.arange(corrs.shape[0])[:, np.newaxis]
+        best = np.argpartition(-corrs, top_n - 1, axis=1)[:, :top_n]
+        order = np.argsort(-corrs[pos, best], axis=1, kind='mergesort')
+        best = best[pos, order]
+        nbr_rows[start:start + block_rows] = best
+        nbr_values[start:start + block_rows] = corrs[pos, best]
+    # values first, rows last: neighbours_fresh checks the rows file
+    for kind, data in (('nbr_values', nbr_values), ('nbr_rows', nbr_rows)):
+        path = matrix_file_path(sidecar_name(name, kind))
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, data)
+        os.rename(path + '.tmp', path)
+
+
+def write_group_stats(name, data, groups, version):
+    """
+        write the group means and standard deviations of the rows of data
+        for each factor of groups ({factor: FactorGroups}) next to matrix
+        file name, indexed by <ds_id>.groups.json. version (the dataset's
+        lastmodified) tells readers whether the layouts are still current
+    """
+    n_rows = data.shape[0]
+    block_rows = max(1, settings.MATRIX_BLOCK_BYTES //
+                     (3 * 8 * max(1, data.shape[1])))
+    index = {'version': version, 'factors': {}}
+    for k, factor in enumerate(sorted(groups)):
+        fg = groups[factor]
+        kind = 'group%d' % k
+        shape = (n_rows, len(fg.counts))
+        paths = [matrix_file_path(sidecar_name(name, kind + '.mean')),
+                 matrix_file_path(sidecar_name(name, kind + '.std'))]
+        means, stds = [np.lib.format.open_memmap(path + '.tmp', mode='w+',
+                                                 dtype=np.float64,
+                                                 shape=shape)
+                       for path in paths]
+        for start in range(0, n_rows, block_rows):
+            stop = start + block_rows
+            means[start:stop], stds[start:stop] = fg.aggregate(
+                data[start:stop])
+        means.flush()
+        stds.flush()
+        del means, stds
+        for path in paths:
+            os.rename(path + '.tmp', path)
+        index['factors'][factor] = kind
+    path = matrix_file_path(sidecar_name(name, 'groups', '.json'))
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.rename(path + '.tmp', path)
+
+
+def open_group_stats(name, version):
+    """
+        {factor: (means, stds)}, memory-mapped, of matrix file name; empty
+        if not built, or built for another version of the dataset
+    """
+    path = matrix_file_path(sidecar_name(name, 'groups', '.json'))
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        index = json.load(f)
+    if index['version'] != version:
+        return {}
+    groups = {}
+    for factor, kind in index['factors'].items():
+        means = open_sidecar(name, kind + '.mean')
+        stds = open_sidecar(name, kind + '.std')
+        if means is not None and stds is not None:
+            groups[factor] = (means, stds)
+    return groups
+
+
+class LoadedMatrix(object):
+    """ A dataset matrix decoded once, as held by the matrix cache """
+
+    def __init__(self, mat, version=None):
+        self.dataset_id = mat.dataset_id
+        self.reporters = mat.reporters
+        self.data = mat.load()
+        # normalised rows for Pearson, and normalised ranks for Spearman
+        self.normed = open_sidecar(mat.path, 'norm') if mat.path else None
+        self._ranked = open_sidecar(mat.path, 'rank') if mat.path else None
+        self._rank_lock = threading.Lock()
+        # not exported yet, or exported before these files existed; large
+        # matrices are instead normalised block by block when correlated
+        small = self.data.nbytes <= settings.MATRIX_BLOCK_BYTES
+        if small and self.normed is None:
+            self.normed = normalise_rows(self.data)
+        # most requests are Pearson, ranks are only computed for the first
+        # Spearman one (see ranked)
+        self._rank_in_memory = small and self._ranked is None
+        # precomputed top correlations (rows, values), see the
+        # build_ds_neighbours command; reopened when rebuilt
+        self.path = mat.path
+        self.nbr = None
+        self._nbr_mtime = None
+        self._nbr_checked = 0
+        self.refresh_neighbours()
+        # collapsed chart values by factor, see write_group_stats
+        self.groups = {}
+        if mat.path and version is not None:
+            self.groups = open_group_stats(mat.path, version)
+        # reporter -> row, first occurrence wins like list.index
+        self.index = {}
+        for i, rep in enumerate(self.reporters):
+            self.index.setdefault(rep, i)
+
+    @property
+    def ranked(self):
+        """ normalised ranks for Spearman, None if not stored or computed """
+        if self._ranked is None and self._rank_in_memory:
+            with self._rank_lock:
+                if self._ranked is None:
+                    self._ranked = spearman_rows(self.data)
+        return self._ranked
+
+    def __contains__(self, reporter):
+        return reporter in self.index
+
+    def row_of(self, reporter):
+        """ row of reporter in the matrix, None if not in this dataset """
+        return self.index.get(reporter)
+
+    def refresh_neighbours(self, check_interval=0):
+        """
+            (re)open the neighbour table if it was built or rebuilt since
+            it was last checked, at most every check_interval seconds.
+            building it doesn't change the dataset, so cached entries
+            would otherwise keep the table they were loaded with
+        """
+        now = time.time()
+        if not self.path or self._nbr_checked + check_interval > now:
+            return
+        self._nbr_checked = now
+        # written last, see write_neighbours
+        path = matrix_file_path(sidecar_name(self.path, 'nbr_rows'))
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        if mtime == self._nbr_mtime:
+            return
+        nbr = None
+        if mtime is not None and neighbours_fresh(self.path):
+            nbr = (open_sidecar(self.path, 'nbr_rows'),
+                   open_sidecar(self.path, 'nbr_values'))
+        self._nbr_mtime = mtime
+        # one assignment, readers see the old table or the new one
+        self.nbr = nbr
+
+    def _method_rows(self, method):
+        """
+            (stored normalised matrix or None, transform of raw rows into
+            normalised rows) for correlation method
+        """
+        if method == 'spearman':
+            return self.ranked, spearman_rows
+        return self.normed, normalise_rows
+
+    def correlate(self, rows, method='pearson'):
+        """
+            Pearson r (or Spearman rho if method is 'spearman') of each of
+            rows against every row of the matrix, as a (len(rows), no. of
+            reporters) float32 array. the matrix is walked in row blocks
+            bounded by settings.MATRIX_BLOCK_BYTES, so memory stays flat
+            whatever the no. of samples, if the matrix is memory-mapped.
+            return (r, peak bytes)
+        """
+        stored, transform = self._method_rows(method)
+        if stored is not None:
+            queries = np.asarray(stored[rows])
+        else:
+            queries = transform(self.data[rows])
+        n_rows, n_cols = self.data.shape
+        # on-the-fly normalisation holds float64 copies and a float32 result
+        row_bytes = n_cols * (4 if stored is not None else 28)
+        block_rows = max(1, settings.MATRIX_BLOCK_BYTES // row_bytes)
+        corrs = np.empty((len(rows), n_rows), dtype=np.float32)
+        for start in range(0, n_rows, block_rows):
+            stop = start + block_rows
+            if stored is not None:
+                block = stored[start:stop]
+            else:
+                block = transform(self.data[start:stop])
+            corrs[:, start:stop] = np.dot(queries, block.T)
+        peak = corrs.nbytes + queries.nbytes + \
+            min(block_rows, n_rows) * row_bytes
+        if not isinstance(self.data, np.memmap):
+            # decoded from the DB, the whole matrix is in memory
+            peak += self.data.nbytes
+        return corrs, peak
+
+    def neighbours(self, row, min_corr, top=None):
+        """
+            (rows, values) correlated to row above min_corr, best first,
+            from the neighbour table. None if there is no table or it may
+            miss some of the answer, the caller then computes it live
+        """
+        nbr = self.nbr
+        if nbr is None:
+            return None
+        nbr_rows, nbr_values = nbr
+        values = nbr_values[row]
+        # complete if the table holds every row, the last stored value
+        # already fails the threshold, or fewer than stored are asked for
+        if not (len(values) == len(self.reporters) or
+                values[-1] <= min_corr or
+                (top is not None and top <= len(values))):
+            return None
+        count = int(np.count_nonzero(values > min_corr))
+        if top is not None:
+            count = min(count, top)
+        return nbr_rows[row][:count], values[:count]
+
+    @property
+    def nbytes(self):
+        """
+            heap memory held by the entry: the reporter list and index, and
+            arrays decoded or computed in memory. memory-mapped files are
+            paged in and out by the OS and not charged
+        """
+        size = sys.getsizeof(self.index) + sys.getsizeof(self.reporters) + \
+            sum(sys.getsizeof(rep) for rep in self.reporters)
+        # neighbour tables are always memory-mapped
+        for arr in (self.data, self.normed):
+            if arr is not None and not isinstance(arr, np.memmap):
+                size += arr.nbytes
+        if self._rank_in_memory:
+            # charged up front, the cache sizes entries once
+            size += self.data.size * np.dtype(np.float32).itemsize
+        return size
+
+
+class MatrixCache(object):
+    """
+        LRU cache of LoadedMatrix keyed on (dataset id, lastmodified), least
+        recently used entries are evicted once max_bytes is exceeded. the
+        neighbour tables of cached entries are checked for rebuilds every
+        check_interval seconds
+    """
+
+    def __init__(self, max_bytes, check_interval=60):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, ds):
+        """
+            return the LoadedMatrix of dataset ds, raise
+            BiogpsDatasetMatrix.DoesNotExist if it has no matrix
+        """
+        key = (ds.id, ds.lastmodified)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # re-insert as most recently used
+                self._entries[key] = entry
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is not None:
+            entry.refresh_neighbours(self.check_interval)
+            return entry
+        # decode outside the lock, other datasets stay available meanwhile
+        from dataset import models
+        mat = models.BiogpsDatasetMatrix.objects.get(dataset=ds)
+        entry = LoadedMatrix(mat, version=ds.lastmodified.isoformat())
+        self.put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            # drop older versions of this dataset, or a concurrent load
+            for k in [k for k in self._entries if k[0] == key[0]]:
+                self._bytes -= self._entries.pop(k).nbytes
+            if entry.nbytes > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._bytes += entry.nbytes
+            while self._bytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= old.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'pid': os.getpid(), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
+
+
+matrix_cache = MatrixCache(settings.MATRIX_CACHE_BYTES)
@@ -2,14 +2,21 @@
 Models for datasets loaded from ArrayExpress
 '''
 import base64
+import logging
+import os
 import types
 import textwrap
+from io import BytesIO
+import numpy as np
+from django.conf import settings
 from django.db import models
 # from django.utils.encoding import smart_unicode
 from django.template.defaultfilters import slugify
 from django_extensions.db.fields import AutoSlugField
 # https://github.com/bradjasper/django-jsonfield
 from jsonfield import JSONField
+from dataset import matrix as matrix_store
+from dataset.factors import collapsed_groups
 import sys
 if sys.version > '3':
     PY3 = True
@@ -99,15 +106,16 @@ class BiogpsDataset(models.Model):
 #                         _fac_txt.add(v)
 #         return ' '.join(_fac_txt)
 
-    # serialize object data for es index setup
-    def es_index_serialize(self):
-        from tagging.models import Tag
+    # serialize object data for es index setup. tags of a batch of
+    # datasets can be passed in, see dataset_tags
+    def es_index_serialize(self, tags=None):
+        if tags is None:
+            tags = dataset_tags([self])[self.id]
         d =    {"name": self.name, "id": self.id, "slug": self.slug,
                 "summary": self.summary, "geo_gse_id": self.geo_gse_id,
                 "sample_count": self.sample_count, "factor_count":
                 self.factor_count, "species": self.platform.species, "tags":
-                list(Tag.objects.get_for_object(self).values_list
-                     ("name", flat=True)), 'is_default': self.is_default}
+                tags, 'is_default': self.is_default}
         if 'sample_geneid' in self.metadata:
             d['sample_geneid'] = self.metadata['sample_geneid']
         return d
@@ -209,6 +217,22 @@ class BiogpsDataset(models.Model):
         return out
 
 
+def dataset_tags(datasets):
+    """ {dataset id: [tag names]} of datasets, loaded with one query """
+    from tagging.models import TaggedItem
+    from django.contrib.contenttypes.models import ContentType
+    tags = dict((ds.id, []) for ds in datasets)
+    if not tags:
+        return tags
+    ctype = ContentType.objects.get_for_model(BiogpsDataset)
+    items = TaggedItem.objects.filter(content_type=ctype,
+                                      object_id__in=list(tags))\
+        .order_by('tag__name').values_list('object_id', 'tag__name')
+    for object_id, name in items:
+        tags[object_id].append(name)
+    return tags
+
+
 #class BiogpsDatasetPopularity(models.Model):
 #    dataset = models.ForeignKey(BiogpsDataset, related_name='dataset_pop')
 #    total = models.IntegerField(default=0)
@@ -220,7 +244,40 @@ class BiogpsDatasetData(models.Model):
     """Model definition for BiogpsDatasetData"""
     dataset = models.ForeignKey(BiogpsDataset, related_name='dataset_data')
     reporter = models.CharField(max_length=200)
-    data = JSONField(blank=False, editable=True)
+    # legacy storage, a JSON list of values; empty once the row is packed
+    data = JSONField(blank=True, null=True, editable=True)
+    # packed storage, raw float bytes of the row in the dtype recorded below
+    _packed = models.BinaryField(db_column='packed', null=True)
+    dtype = models.CharField(max_length=10, blank=True)
+
+    def get_values(self):
+        """ Return the row as a NumPy array, whichever way it is stored """
+        if self._packed is not None:
+            return np.frombuffer(self._packed, dtype=self.dtype)
+        return np.array(self.data, dtype=np.float64)
+
+    def set_values(self, values):
+        if settings.DATASET_DATA_STORAGE == 'packed':
+            self.pack(values)
+        else:
+            self.data = [float(v) for v in values]
+            self._packed = None
+            self.dtype = ''
+
+    values = property(get_values, set_values)
+
+    def pack(self, values=None, dtype=None):
+        """ Store values (or the current JSON row) as a packed float blob """
+        if values is None:
+            values = self.get_values()
+        dtype = np.dtype(dtype or settings.DATASET_DATA_DTYPE)
+        self._packed = np.asarray(values, dtype=dtype).tobytes()
+        self.dtype = dtype.str
+        self.data = None
+
+    @property
+    def is_packed(self):
+        return self._packed is not None
 
     class Meta:
         unique_together = ("dataset", "reporter")
@@ -235,7 +292,11 @@ class BiogpsDatasetMatrix(models.Model):
     dataset = models.OneToOneField(BiogpsDataset,
                                    related_name='dataset_matrix')
     reporters = JSONField(blank=False, editable=True)
-    _matrix = models.TextField(db_column='matrix')
+    # legacy storage, base64 of the np.save output; empty once exported
+    _matrix = models.TextField(db_column='matrix', blank=True)
+    # file name in settings.DATASET_MATRIX_DIR and its md5
+    path = models.CharField(max_length=255, blank=True)
+    checksum = models.CharField(max_length=32, blank=True)
 
     def get_data(self):
         # return bytes under py3
@@ -250,6 +311,66 @@ class BiogpsDatasetMatrix(models.Model):
 
     matrix = property(get_data, set_data)
 
+    def has_file(self):
+        """ True if the matrix file is in this host's matrix store """
+        return bool(self.path) and \
+            os.path.exists(matrix_store.matrix_file_path(self.path))
+
+    def load(self):
+        """
+            Return the matrix as a NumPy array, memory-mapped if the matrix
+            file is on this host, decoded from the DB otherwise. raise
+            DoesNotExist if it is in neither place
+        """
+        if self.has_file():
+            return matrix_store.open_matrix_file(self.path)
+        if not self._matrix:
+            # exported on another host, and the DB copy dropped
+            raise BiogpsDatasetMatrix.DoesNotExist(
+                'matrix file {} of dataset {} is missing'.format(
+                    self.path, self.dataset_id))
+        return np.load(BytesIO(self.matrix))
+
+    def store(self, data, keep_blob=True):
+        """
+            Write data to the matrix store and point this matrix to it.
+            the DB copy is kept unless keep_blob is False: loaders may run
+            on another host than the web servers, whose matrix store then
+            lacks the file until export_ds_matrix is run there
+        """
+        self.path, self.checksum = matrix_store.write_matrix_file(
+            self.dataset_id, data)
+        if keep_blob:
+            s = BytesIO()
+            np.save(s, np.ascontiguousarray(data))
+            self.matrix = s.getvalue()
+        else:
+            self._matrix = ''
+        self.build_derived(data)
+
+    def build_derived(self, data=None):
+        """ (Re)write the derived files kept next to the matrix file """
+        if data is None:
+            data = self.load()
+        matrix_store.write_normalised_rows(self.path, data)
+        matrix_store.write_rank_matrix(self.path, data)
+        ds = self.dataset
+        try:
+            matrix_store.write_group_stats(self.path, data,
+                                           collapsed_groups(ds),
+                                           ds.lastmodified.isoformat())
+        except Exception as e:
+            # only a shortcut for collapsed charts, which are otherwise
+            # computed live; don't fail the load for it
+            logging.warning('group stats of dataset %s not written: %s',
+                            self.dataset_id, e)
+
+    def verify(self):
+        """ True if the matrix file exists and matches its checksum """
+        path = matrix_store.matrix_file_path(self.path)
+        return os.path.exists(path) and \
+            matrix_store.file_checksum(path) == self.checksum
+
     class Meta:
         verbose_name_plural = "Dataset Matrix"
 
@@ -271,6 +392,40 @@ class BiogpsDatasetPlatform(models.Model):
         return (u'%s' % (self.platform))
 
 
+class BiogpsDatasetReporterAnnotation(models.Model):
+    """Gene id and symbol of platform reporters, filled in at load time.
+       reporter is lower case; a reporter without a gene has one row with
+       empty gene_id and symbol"""
+    platform = models.ForeignKey(BiogpsDatasetPlatform,
+                                 related_name='reporter_annotations')
+    reporter = models.CharField(max_length=128)
+    gene_id = models.CharField(max_length=32, blank=True)
+    symbol = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        index_together = ("platform", "reporter")
+        verbose_name_plural = "Dataset Reporter Annotation"
+
+    def __unicode__(self):
+        return (u'%s %s' % (self.reporter, self.symbol))
+
+
+class BiogpsDatasetGeneDefault(models.Model):
+    """Default dataset of a gene, built by the build_ds_defaults command.
+       dataset is null when no dataset has data for the gene"""
+    gene_id = models.CharField(max_length=32)
+    taxid = models.IntegerField()
+    dataset = models.ForeignKey(BiogpsDataset, null=True,
+                                related_name='default_of_genes')
+
+    class Meta:
+        unique_together = ("gene_id", "taxid")
+        verbose_name_plural = "Dataset Gene Default"
+
+    def __unicode__(self):
+        return (u'%s %s' % (self.gene_id, self.dataset_id))
+
+
 class BiogpsDatasetGeoLoaded(models.Model):
     """Model definition for BiogpsDatasetGeoLoaded. This model tracks what
        GEO datasets have been loaded."""
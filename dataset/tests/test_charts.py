@@ -0,0 +1,167 @@
+'''
+SVG bar charts drawn by dataset.charts.render_svg, the chart file cache and
+the chart renderer worker pool.
+'''
+import os
+import shutil
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ET
+from django.conf import settings
+from django.test import SimpleTestCase
+from dataset.charts import ChartBusy, ChartCache, ChartRenderer, render_svg
+
+SVG = '{http://www.w3.org/2000/svg}'
+
+
+class RenderSvgTest(SimpleTestCase):
+
+    def chart(self, back):
+        return ET.fromstring(render_svg(back))
+
+    def bars(self, root):
+        # the first rect is the background
+        return root.findall(SVG + 'rect')[1:]
+
+    def test_bars(self):
+        back = [{'name': 'liver', 'value': 120.5, 'dev': 3.2, 'color_idx': 0},
+                {'name': 'brain <CNS> & co', 'value': 8.0, 'dev': 0,
+                 'color_idx': 1},
+                {'name': 'GSM3', 'value': -4.0, 'dev': 0.5, 'color_idx': 7}]
+        root = self.chart(back)
+        bars = self.bars(root)
+        self.assertEqual(len(back), len(bars))
+        colors = settings.BAR_COLORS
+        self.assertEqual([colors[e['color_idx'] % len(colors)] for e in back],
+                         [b.get('fill') for b in bars])
+        # bar length follows the value, negative bars left of the y axis
+        widths = [float(b.get('width')) for b in bars]
+        self.assertGreater(widths[0], widths[1])
+        self.assertLess(float(bars[2].get('x')), float(bars[0].get('x')))
+        # one error bar per element with a deviation
+        self.assertEqual(2, len(root.findall(SVG + 'path')))
+        labels = [t.text for t in root.findall(SVG + 'text')]
+        for e in back:
+            self.assertIn(e['name'], labels)
+        self.assertIn('M(8.0)', labels)
+
+    def test_first_element_at_bottom(self):
+        back = [{'name': 'a', 'value': 1.0, 'dev': 0, 'color_idx': 0},
+                {'name': 'b', 'value': 2.0, 'dev': 0, 'color_idx': 0}]
+        bars = self.bars(self.chart(back))
+        self.assertGreater(float(bars[0].get('y')), float(bars[1].get('y')))
+
+
+
+class ChartCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ChartCache(self.dir, 2500, check_every=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def files(self):
+        return sorted(fn for _, _, names in os.walk(self.dir)
+                      for fn in names)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('ab12'))
+        self.cache.put('ab12', b'png')
+        self.assertEqual(b'png', self.cache.get('ab12'))
+        self.assertIsNone(self.cache.get('ab12', '.svg'))
+
+    def test_concurrent_put(self):
+        # threads storing the same chart each write a temp file of their own
+        threads = [threading.Thread(target=self.cache.put,
+                                    args=('ab12', b'x' * 100000))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(b'x' * 100000, self.cache.get('ab12'))
+        self.assertEqual(['ab12.png'], self.files())
+
+    def test_evict(self):
+        for i, key in enumerate(['aa01', 'bb02', 'cc03', 'dd04']):
+            self.cache.put(key, b'x' * 1000)
+            # distinct mtimes, aa01 is the oldest
+            path = os.path.join(self.dir, key[:2], key + '.png')
+            os.utime(path, (i * 10, i * 10))
+        self.cache.get('aa01')
+        self.assertEqual(2, self.cache.evict())
+        self.assertEqual(['aa01.png', 'dd04.png'], self.files())
+
+    def test_evict_on_put(self):
+        cache = ChartCache(self.dir, 2500, check_every=3)
+        cache.put('aa01', b'x' * 1000)
+        cache.put('bb02', b'x' * 1000)
+        cache.put('cc03', b'x' * 1000)
+        self.assertEqual(2, len(self.files()))
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+class ChartRendererTest(SimpleTestCase):
+
+    def setUp(self):
+        # one worker, two slots, charts time out after 2s
+        self.renderer = ChartRenderer(1, 2, 2, 10)
+        self.failed = []
+
+    def tearDown(self):
+        self.renderer.terminate()
+
+    def render_later(self, delay, *args):
+        """ render in a thread after delay, recording when ChartBusy came """
+        def render():
+            time.sleep(delay)
+            start = time.time()
+            try:
+                self.renderer.render(*args)
+            except ChartBusy:
+                self.failed.append(time.time() - start)
+        thread = threading.Thread(target=render)
+        thread.start()
+        return thread
+
+    def test_render(self):
+        self.assertIsNone(self.renderer.render(time.sleep, 0))
+        with self.assertRaises(ValueError):
+            self.renderer.render(fail, 'broken chart')
+
+    def test_queue_full(self):
+        threads = [self.render_later(0, time.sleep, 30) for i in range(2)]
+        time.sleep(0.5)
+        start = time.time()
+        with self.assertRaises(ChartBusy):
+            self.renderer.render(time.sleep, 0)
+        self.assertLess(time.time() - start, 0.5)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, len(self.failed))
+
+    def test_timeout_resets_pool(self):
+        # the chart queued behind the hung one fails when the pool is reset,
+        # 1s after it was queued, instead of waiting out its own 2s
+        self.renderer.render(time.sleep, 0)
+        pool = self.renderer._pool
+        thread = self.render_later(1, time.sleep, 0)
+        with self.assertRaises(ChartBusy):
+            self.renderer.render(time.sleep, 30)
+        thread.join()
+        self.assertEqual(1, len(self.failed))
+        self.assertLess(self.failed[0], 1.5)
+        self.assertIsNone(self.renderer._pool)
+        # both slots are free again and a new pool renders
+        for i in range(2):
+            self.assertTrue(self.renderer._slots.acquire(False))
+        for i in range(2):
+            self.renderer._slots.release()
+        self.assertIsNone(self.renderer.render(time.sleep, 0))
+        self.assertIsNot(pool, self.renderer._pool)
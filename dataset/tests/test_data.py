@@ -0,0 +1,70 @@
+'''
+Dataset data rows stored packed or as JSON lists (BiogpsDatasetData), and
+their conversion back to JSON.
+'''
+import json
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+from dataset.models import BiogpsDatasetData
+from dataset.util import ComplexEncoder, to_float_list
+
+
+class ToFloatListTest(SimpleTestCase):
+
+    def test_float32(self):
+        # shortest repr of the float32 value, not its float64 expansion
+        values = np.array([12.3, -0.1, 1e-7, 5], dtype='<f4')
+        self.assertEqual([12.3, -0.1, 1e-7, 5.0], to_float_list(values))
+
+    def test_float64(self):
+        values = np.array([12.3, 0.1 + 0.2])
+        self.assertEqual(values.tolist(), to_float_list(values))
+
+    def test_list(self):
+        self.assertEqual([1.0, 2.5, -3.0], to_float_list([1, '2.5', -3]))
+
+    def test_encoder(self):
+        values = np.array([12.3, -0.1], dtype='<f4')
+        self.assertEqual('{"values": [12.3, -0.1]}',
+                         json.dumps({'values': values}, cls=ComplexEncoder))
+
+
+class DatasetDataTest(SimpleTestCase):
+
+    values = [1.5, 12.3, -3.0, 0.0, 1234.567]
+
+    @override_settings(DATASET_DATA_STORAGE='packed',
+                       DATASET_DATA_DTYPE='<f4')
+    def test_packed(self):
+        row = BiogpsDatasetData(reporter='1007_s_at', values=self.values)
+        self.assertTrue(row.is_packed)
+        self.assertIsNone(row.data)
+        self.assertEqual('<f4', row.dtype)
+        self.assertEqual(len(self.values) * 4, len(row._packed))
+        self.assertEqual(self.values, to_float_list(row.values))
+
+    @override_settings(DATASET_DATA_STORAGE='packed',
+                       DATASET_DATA_DTYPE='<f8')
+    def test_packed_float64(self):
+        values = [0.1 + 0.2, 1e-300, -7.0]
+        row = BiogpsDatasetData(reporter='1007_s_at', values=values)
+        self.assertEqual(values, row.values.tolist())
+
+    @override_settings(DATASET_DATA_STORAGE='json')
+    def test_json(self):
+        row = BiogpsDatasetData(reporter='1007_s_at', values=self.values)
+        self.assertFalse(row.is_packed)
+        self.assertEqual(self.values, row.data)
+        self.assertEqual(self.values, row.values.tolist())
+
+    @override_settings(DATASET_DATA_DTYPE='<f4')
+    def test_pack_json_row(self):
+        # as pack_ds_data converts rows loaded before packing
+        row = BiogpsDatasetData(reporter='1007_s_at', data=self.values)
+        row.pack()
+        self.assertTrue(row.is_packed)
+        self.assertIsNone(row.data)
+        self.assertEqual(self.values, to_float_list(row.values))
+        # from the DB the blob comes back as a buffer
+        row._packed = memoryview(row._packed)
+        self.assertEqual(self.values, to_float_list(row.values))
@@ -0,0 +1,183 @@
+'''
+Sample layouts and chart aggregation (dataset.factors) checked against the
+implementation they replaced, kept here as the reference.
+'''
+import math
+import random
+import unittest
+import numpy as np
+from dataset.factors import factor_layout, get_ds_factors, \
+    get_sample_name_list, FactorGroups, collapsed_groups
+
+
+def old_get_ds_factors_keys(ds, group=None, collapse=False, naming=None):
+    factors = []
+    names = []
+    fvs = []
+    if group is not None:
+        for j, f in enumerate(get_ds_factors(ds)):
+            if group not in f:
+                return None
+            v = f[group]
+            if v not in fvs:
+                fvs.append(v)
+            color_idx = fvs.index(v)
+            if collapse:
+                names.append(v)
+            factors.append({'order_idx': v, 'color_idx': color_idx})
+    else:
+        i = 1
+        for f in ds.metadata['factors']:
+            content = f[list(f)[0]]
+            if 'order_idx' in content and 'color_idx' in content:
+                order_idx = content['order_idx']
+                color_idx = content['color_idx']
+            else:
+                color_idx = order_idx = i
+                i = i + 1
+            factors.append({'order_idx': order_idx, 'color_idx': color_idx})
+    if len(names) == 0:
+        names = get_sample_name_list(ds, naming)
+    for j, e in enumerate(factors):
+        e['name'] = names[j]
+    if group:
+        fvs.sort()
+        t = {}
+        interval = len(ds.metadata['factors'])
+        for e in factors:
+            val = e['order_idx']
+            od = interval*fvs.index(val)
+            if not collapse:
+                if val in t:
+                    t[val] += 1
+                    inc = t[val]
+                else:
+                    inc = t[val] = 0
+                od += inc
+            e['order_idx'] = od
+    return factors
+
+
+def old_prepare_chart_data(val_list, factors):
+    """ the old grouping, values as lists; aggregated by the caller """
+    import copy
+    factors = copy.deepcopy(factors)
+    for idx, e in enumerate(factors):
+        e['value'] = val_list[idx]
+    factors.sort(key=lambda e: e['order_idx'], reverse=True)
+    res = [factors[0]]
+    for e in factors[1:]:
+        if e['order_idx'] != res[-1]['order_idx']:
+            res.append(e)
+        else:
+            last_value = res[-1]['value']
+            if type(last_value) is list:
+                last_value.append(e['value'])
+            else:
+                res[-1]['value'] = [last_value, e['value']]
+    for e in res:
+        if e['name'].startswith('GSM'):
+            e['name'] = e['name'].rstrip(' 1')
+        else:
+            e['name'] = e['name'].rstrip(' ')
+    return res
+
+
+class FakeDataset(object):
+
+    def __init__(self, metadata, factors=None):
+        self.metadata = metadata
+        self.factors = factors
+
+
+def random_dataset(rnd, n_samples, preset_order=False, missing=False):
+    samples = []
+    for i in range(n_samples):
+        fv = {'TISSUE': rnd.choice(['liver', 'brain', 'heart', 'lung']),
+              'AGE': rnd.choice(['1', '2']),
+              'STRAIN': 'C57BL/6'}
+        if missing and i == n_samples - 1:
+            del fv['AGE']
+        content = {'factorvalue': fv}
+        if preset_order:
+            content['order_idx'] = rnd.randint(1, 5)
+            content['color_idx'] = rnd.randint(0, 3)
+        name = 'GSM%d 1' % i if i % 2 else 'sample %d ' % i
+        samples.append({name: content})
+    return FakeDataset({'factors': samples})
+
+
+class FactorLayoutTest(unittest.TestCase):
+
+    def test_layout_unchanged(self):
+        rnd = random.Random(0)
+        for n in (1, 2, 7, 30):
+            for preset in (False, True):
+                ds = random_dataset(rnd, n, preset_order=preset,
+                                    missing=n > 2)
+                for group in (None, 'TISSUE', 'AGE', 'STRAIN', 'NOPE'):
+                    for collapse in (False, True):
+                        for naming in (None, 'TISSUE'):
+                            old = old_get_ds_factors_keys(ds, group,
+                                                          collapse, naming)
+                            new = factor_layout(ds, group, collapse, naming)
+                            self.assertEqual(False if old is None else old,
+                                             new)
+
+
+class FactorGroupsTest(unittest.TestCase):
+
+    def check_rows(self, values, factors):
+        groups = FactorGroups(factors)
+        rows = groups.chart_rows(values)
+        for row_values, res in zip(values, rows):
+            ref = old_prepare_chart_data(list(row_values), factors)
+            self.assertEqual(len(ref), len(res))
+            for r, e in zip(ref, res):
+                for k in ('order_idx', 'color_idx', 'name'):
+                    self.assertEqual(r[k], e[k])
+                if type(r['value']) is list:
+                    self.assertEqual(round(np.mean(r['value']), 2),
+                                     e['value'])
+                    self.assertAlmostEqual(np.std(r['value']), e['dev'],
+                                           delta=0.0005 + 1e-9)
+                else:
+                    self.assertEqual(r['value'], e['value'])
+                    self.assertEqual(e['dev'], 0)
+
+    def test_chart_data_unchanged(self):
+        rnd = random.Random(1)
+        for n in (1, 5, 40):
+            ds = random_dataset(rnd, n)
+            values = [[rnd.uniform(-5, 500) for _ in range(n)]
+                      for _ in range(3)]
+            for group in (None, 'TISSUE', 'AGE'):
+                for collapse in (False, True):
+                    factors = factor_layout(ds, group, collapse, None)
+                    self.check_rows(values, factors)
+
+    def test_deviation(self):
+        # the old _avg_with_deviation only summed the last sample: 0.577
+        factors = [{'order_idx': 1, 'color_idx': 0, 'name': 'a'}] * 3
+        res = FactorGroups(factors).chart_rows([[1.0, 2.0, 3.0]])[0]
+        self.assertEqual(1, len(res))
+        self.assertEqual(2.0, res[0]['value'])
+        self.assertEqual(round(math.sqrt(2 / 3.0), 3), res[0]['dev'])
+
+    def test_aggregate_blocks(self):
+        # group stats are written block by block, rows are independent
+        rnd = random.Random(2)
+        ds = random_dataset(rnd, 20)
+        groups = FactorGroups(factor_layout(ds, 'TISSUE', True, None))
+        values = np.random.RandomState(0).rand(9, 20)
+        means, stds = groups.aggregate(values)
+        for start in range(0, 9, 4):
+            m, s = groups.aggregate(values[start:start + 4])
+            np.testing.assert_array_equal(means[start:start + 4], m)
+            np.testing.assert_array_equal(stds[start:start + 4], s)
+
+    def test_collapsed_groups(self):
+        rnd = random.Random(3)
+        ds = random_dataset(rnd, 10, missing=True)
+        # STRAIN has one value, AGE is missing from a sample
+        self.assertEqual(['TISSUE'], list(collapsed_groups(ds)))
@@ -0,0 +1,206 @@
+'''
+Coalescing of mygene.info lookups by dataset.genes.GeneDocCache, the
+gene -> miRNA map, and the platform reporter filter.
+'''
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+import numpy as np
+from django.test import SimpleTestCase
+from dataset.genes import GeneDocCache, GeneMirnaMap, PlatformReporters, \
+    write_gene_mirna
+
+
+class FakeMyGeneInfo(object):
+    """ answers getgenes from docs, recording the genes of each call """
+
+    def __init__(self, docs, calls, error=None, delay=0.05):
+        self.docs = docs
+        self.calls = calls
+        self.error = error
+        self.delay = delay
+
+    def getgenes(self, genes, fields=None, verbose=True):
+        self.calls.append(list(genes))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return [dict(self.docs[g], query=g) if g in self.docs
+                else {'query': g, 'notfound': True} for g in genes]
+
+
+class GeneDocCacheTest(SimpleTestCase):
+
+    def lookup(self, cache, genes, docs, error=None):
+        """ look genes up concurrently, return (results, getgenes calls) """
+        calls = []
+        results = {}
+
+        def get(i, gene):
+            try:
+                results[i] = cache.get(gene)
+            except Exception as e:
+                results[i] = e
+        with mock.patch('dataset.genes.mygene.MyGeneInfo',
+                        lambda: FakeMyGeneInfo(docs, calls, error)):
+            threads = [threading.Thread(target=get, args=(i, gene))
+                       for i, gene in enumerate(genes)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        return [results[i] for i in range(len(genes))], calls
+
+    def test_coalesced(self):
+        cache = GeneDocCache(60, 0.1, ['taxid'])
+        docs = {'1017': {'taxid': 9606}, '12566': {'taxid': 10090}}
+        genes = ['1017', '12566', '1017', '99', '1017']
+        results, calls = self.lookup(cache, genes, docs)
+        # one outbound call for every gene, each gene asked once
+        self.assertEqual(1, len(calls))
+        self.assertEqual(sorted(set(genes)), sorted(calls[0]))
+        self.assertEqual([9606, 10090, 9606], [results[i]['taxid']
+                                               for i in (0, 1, 2)])
+        self.assertIsNone(results[3])
+        # served from the cache, unknown genes too
+        results, calls = self.lookup(cache, genes, docs)
+        self.assertEqual([], calls)
+        self.assertIsNone(results[3])
+
+    def test_error(self):
+        cache = GeneDocCache(60, 0.1, ['taxid'])
+        results, calls = self.lookup(cache, ['1017', '1017'], {},
+                                     error=IOError('down'))
+        self.assertEqual(1, len(calls))
+        self.assertTrue(all(isinstance(r, IOError) for r in results))
+        # errors are not cached
+        results, calls = self.lookup(cache, ['1017'],
+                                     {'1017': {'taxid': 9606}})
+        self.assertEqual(1, len(calls))
+        self.assertEqual(9606, results[0]['taxid'])
+
+    def test_expiry(self):
+        cache = GeneDocCache(0, 0, ['taxid'])
+        docs = {'1017': {'taxid': 9606}}
+        self.lookup(cache, ['1017'], docs)
+        calls = self.lookup(cache, ['1017'], docs)[1]
+        self.assertEqual(1, len(calls))
+
+
+class FakeShelve(dict):
+
+    def close(self):
+        pass
+
+
+class GeneMirnaMapTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'gene2mirna.json')
+        self.shelve_path = os.path.join(self.dir, 'gene2mirna.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_missing(self):
+        mirna = GeneMirnaMap(self.path, self.shelve_path, check_interval=0)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual([], mirna.get(1017))
+
+    def test_shelve_fallback(self):
+        open(self.shelve_path, 'w').close()
+        mirna = GeneMirnaMap(self.path, self.shelve_path, check_interval=0)
+        shelf = FakeShelve({'1017': 'hsa-mir-1', '12566': ['mmu-mir-1']})
+        with mock.patch('dataset.genes.shelve.open',
+                        return_value=shelf) as shelve_open:
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(['hsa-mir-1'], mirna.get(1017))
+            self.assertEqual(['mmu-mir-1'], mirna.get('12566'))
+            # read once
+            self.assertEqual(1, shelve_open.call_count)
+        # the converted file replaces it once written
+        write_gene_mirna(self.path, {'1017': ['hsa-mir-2']})
+        self.assertEqual(['hsa-mir-2'], mirna.get(1017))
+        self.assertEqual([], mirna.get(12566))
+
+
+class FakeDataset(object):
+
+    def __init__(self, id, platform_id, lastmodified):
+        self.id = id
+        self.platform_id = platform_id
+        self.lastmodified = lastmodified
+
+
+class PlatformReportersTest(SimpleTestCase):
+
+    def setUp(self):
+        self.platform = ['1007_s_at', '1053_at', '117_at', '121_at']
+        self.day = datetime.datetime(2017, 4, 4)
+
+    def may_contain(self, ds, reporters, matrix_reporters,
+                    platforms=None):
+        """ may_contain(ds, reporters), the matrix of ds having
+            matrix_reporters; also returns the no. of matrix queries """
+        platforms = platforms or PlatformReporters()
+        with mock.patch('dataset.genes.models.BiogpsDatasetPlatform.objects')\
+                as platform_objs, \
+                mock.patch('dataset.genes.models.BiogpsDatasetMatrix.objects')\
+                as matrix_objs:
+            platform_objs.only.return_value.get.return_value.reporters = \
+                self.platform
+            matrix_objs.only.return_value.get.return_value.reporters = \
+                matrix_reporters
+            found = platforms.may_contain(ds, reporters)
+        return found, matrix_objs.only.return_value.get.call_count
+
+    def test_found(self):
+        arr = np.array(sorted(r.encode('utf-8') for r in self.platform),
+                       dtype=bytes)
+        self.assertEqual(
+            [True, True, False, False, False],
+            PlatformReporters._found(
+                arr, ['1053_AT', '1007_s_at', '0_at', '2_at', '1054_at'])
+            .tolist())
+
+    def test_covered(self):
+        # every reporter of the dataset is on its platform list
+        ds = FakeDataset(1, 10, self.day)
+        self.assertEqual((True, 0),
+                         self.may_contain(ds, ['117_AT'], self.platform[:2]))
+        self.assertEqual((False, 1),
+                         self.may_contain(ds, ['999_at'], self.platform[:2]))
+        self.assertEqual((False, 0), self.may_contain(ds, [], []))
+
+    def test_uncovered(self):
+        # a locally loaded dataset with reporters off its platform list is
+        # not filtered
+        ds = FakeDataset(1, 10, self.day)
+        self.assertEqual((True, 1),
+                         self.may_contain(ds, ['12566'], ['12566', '1017']))
+
+    def test_coverage_per_version(self):
+        platforms = PlatformReporters()
+        ds = FakeDataset(1, 10, self.day)
+        self.assertEqual((False, 1), self.may_contain(
+            ds, ['999_at'], self.platform, platforms))
+        self.assertEqual((False, 0), self.may_contain(
+            ds, ['999_at'], self.platform, platforms))
+        # reloaded with other reporters
+        ds.lastmodified = datetime.datetime(2017, 5, 1)
+        self.assertEqual((True, 1), self.may_contain(
+            ds, ['999_at'], ['999_at'], platforms))
+
+    def test_unfiltered(self):
+        self.assertEqual((True, 0),
+                         self.may_contain(FakeDataset(1, None, self.day),
+                                          ['999_at'], []))
+        self.platform = []
+        self.assertEqual((True, 0),
+                         self.may_contain(FakeDataset(1, 10, self.day),
+                                          ['999_at'], []))
@@ -0,0 +1,207 @@
+'''
+Correlation by the matrix store (dataset.matrix) checked against numpy and
+pandas, and the per-process matrix cache.
+'''
+import datetime
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase, override_settings
+from dataset import matrix as matrix_store
+
+
+class FakeMatrix(object):
+    """ the BiogpsDatasetMatrix fields LoadedMatrix reads """
+
+    def __init__(self, path, reporters):
+        self.dataset_id = 1
+        self.path = path
+        self.reporters = reporters
+
+    def load(self):
+        return matrix_store.open_matrix_file(self.path)
+
+
+class FakeDataset(object):
+
+    def __init__(self, id, lastmodified):
+        self.id = id
+        self.lastmodified = lastmodified
+
+
+class LoadedMatrixTest(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # blocks of a few rows, so every pass walks several of them
+        self.settings = override_settings(DATASET_MATRIX_DIR=self.dir,
+                                          MATRIX_BLOCK_BYTES=1024)
+        self.settings.enable()
+        rnd = np.random.RandomState(0)
+        self.data = rnd.rand(60, 12)
+        # correlated rows, ties and a constant row
+        self.data[1] = self.data[0] * 2 + 1
+        self.data[2] = np.round(self.data[3] * 3)
+        self.data[4] = 5
+        self.reporters = ['r%d' % i for i in range(len(self.data))]
+        name = matrix_store.write_matrix_file(1, self.data)[0]
+        matrix_store.write_normalised_rows(name, self.data)
+        matrix_store.write_rank_matrix(name, self.data)
+        self.mat = FakeMatrix(name, self.reporters)
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.dir)
+
+    def assert_corrs(self, expected, corrs):
+        np.testing.assert_allclose(expected, corrs, atol=1e-5)
+
+    def test_pearson(self):
+        loaded = matrix_store.LoadedMatrix(self.mat)
+        rows = [0, 3, 4, 59]
+        corrs = loaded.correlate(rows)[0]
+        expected = pd.DataFrame(self.data.T).corr().values[rows]
+        self.assert_corrs(expected, corrs)
+
+    def test_spearman(self):
+        loaded = matrix_store.LoadedMatrix(self.mat)
+        rows = [0, 2, 4, 59]
+        corrs = loaded.correlate(rows, method='spearman')[0]
+        expected = pd.DataFrame(self.data.T).corr(method='spearman')\
+            .values[rows]
+        self.assert_corrs(expected, corrs)
+
+    def test_normalised_on_the_fly(self):
+        # no stored normalised matrices, rows are normalised block by block
+        for kind in ('norm', 'rank'):
+            os.remove(matrix_store.matrix_file_path(
+                matrix_store.sidecar_name(self.mat.path, kind)))
+        loaded = matrix_store.LoadedMatrix(self.mat)
+        self.assertIsNone(loaded.normed)
+        self.assertIsNone(loaded.ranked)
+        for method in ('pearson', 'spearman'):
+            expected = pd.DataFrame(self.data.T).corr(method=method)\
+                .values[[0, 7]]
+            corrs, peak = loaded.correlate([0, 7], method=method)
+            self.assert_corrs(expected, corrs)
+            self.assertGreater(peak, corrs.nbytes)
+
+    def test_ranks_computed_lazily(self):
+        # a small matrix without a rank file is ranked on first use
+        os.remove(matrix_store.matrix_file_path(
+            matrix_store.sidecar_name(self.mat.path, 'rank')))
+        with override_settings(MATRIX_BLOCK_BYTES=1 << 20):
+            loaded = matrix_store.LoadedMatrix(self.mat)
+            size = loaded.nbytes
+            loaded.correlate([0])
+            self.assertIsNone(loaded._ranked)
+            corrs = loaded.correlate([0, 2], method='spearman')[0]
+        self.assertIsNotNone(loaded._ranked)
+        self.assertEqual(size, loaded.nbytes)
+        expected = pd.DataFrame(self.data.T).corr(method='spearman')\
+            .values[[0, 2]]
+        self.assert_corrs(expected, corrs)
+
+    def test_decoded_matrix_in_peak(self):
+        # a matrix decoded from the DB is in memory whole while correlated
+        mat = FakeMatrix(self.mat.path, self.reporters)
+        mat.load = lambda: np.array(self.data)
+        peak = matrix_store.LoadedMatrix(mat).correlate([0])[1]
+        self.assertGreater(peak, self.data.nbytes)
+
+    def test_neighbours_complete(self):
+        matrix_store.write_neighbours(self.mat.path, 10)
+        loaded = matrix_store.LoadedMatrix(self.mat)
+        self.assertIsNotNone(loaded.nbr)
+        corrs = loaded.correlate(list(range(len(self.data))))[0]
+        answered = 0
+        for row in range(len(self.data)):
+            for min_corr in (-1.0, 0.0, 0.5, 0.9):
+                for top in (None, 1, 5, 10, 20):
+                    nbrs = loaded.neighbours(row, min_corr, top)
+                    if nbrs is None:
+                        continue
+                    answered += 1
+                    # the rows a live correlation would select
+                    live = np.where(corrs[row] > min_corr)[0]
+                    live = live[np.argsort(-corrs[row][live],
+                                           kind='mergesort')]
+                    if top is not None:
+                        live = live[:top]
+                    # rows of equal r may be picked in another order
+                    np.testing.assert_allclose(corrs[row][live], nbrs[1],
+                                               atol=1e-5)
+                    np.testing.assert_allclose(corrs[row][nbrs[0]],
+                                               nbrs[1], atol=1e-5)
+        self.assertTrue(answered)
+
+    def test_neighbours_rebuilt(self):
+        # a cached matrix picks up a table built or rebuilt after it
+        ds = FakeDataset(1, datetime.datetime(2016, 5, 1))
+        cache = matrix_store.MatrixCache(1 << 30, check_interval=0)
+        cache.put((ds.id, ds.lastmodified),
+                  matrix_store.LoadedMatrix(self.mat))
+        self.assertIsNone(cache.get(ds).nbr)
+        matrix_store.write_neighbours(self.mat.path, 5)
+        self.assertEqual((60, 5), cache.get(ds).nbr[0].shape)
+        matrix_store.write_neighbours(self.mat.path, 8)
+        self.assertEqual((60, 8), cache.get(ds).nbr[0].shape)
+        self.assertEqual(3, cache.hits)
+        # not checked again within check_interval
+        cache.check_interval = 3600
+        matrix_store.write_neighbours(self.mat.path, 3)
+        self.assertEqual((60, 8), cache.get(ds).nbr[0].shape)
+
+
+class FakeEntry(object):
+    """ a cached LoadedMatrix of nbytes """
+
+    def __init__(self, mat=None, version=None, nbytes=100):
+        self.nbytes = nbytes
+        self.refreshed = 0
+
+    def refresh_neighbours(self, check_interval=0):
+        self.refreshed += 1
+
+
+class MatrixCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = matrix_store.MatrixCache(250)
+        self.day = datetime.datetime(2017, 4, 4)
+
+    def test_get(self):
+        ds = FakeDataset(1, self.day)
+        with mock.patch('dataset.models.BiogpsDatasetMatrix.objects') as objs,\
+                mock.patch('dataset.matrix.LoadedMatrix', FakeEntry):
+            entry = self.cache.get(ds)
+            self.assertIs(entry, self.cache.get(ds))
+            # an edited dataset is loaded again, replacing the old version
+            edited = self.cache.get(FakeDataset(1, datetime.datetime.now()))
+        self.assertIsNot(entry, edited)
+        self.assertEqual(2, objs.get.call_count)
+        self.assertEqual(1, entry.refreshed)
+        stats = self.cache.stats()
+        self.assertEqual((1, 2, 1, 100),
+                         (stats['hits'], stats['misses'], stats['entries'],
+                          stats['bytes']))
+
+    def test_evict(self):
+        for i in range(1, 4):
+            self.cache.put((i, self.day), FakeEntry())
+        self.assertEqual([(2, self.day), (3, self.day)],
+                         list(self.cache._entries))
+        # a hit makes 2 the most recently used, 3 goes next
+        self.cache.get(FakeDataset(2, self.day))
+        self.cache.put((4, self.day), FakeEntry())
+        self.assertEqual([(2, self.day), (4, self.day)],
+                         list(self.cache._entries))
+        # too big to cache at all
+        self.cache.put((5, self.day), FakeEntry(nbytes=300))
+        stats = self.cache.stats()
+        self.assertEqual((2, 2, 200),
+                         (stats['evictions'], stats['entries'],
+                          stats['bytes']))
@@ -25,6 +25,11 @@ urlpatterns = patterns(
     url(r'^correlation/(?P<ds_id>.+)/reporter/(?P<reporter_id>.+)/min/(?P<min_corr>.+)/$',
         views.dataset_correlation,
         name='dataset correlation'),
+    # POST a list of reporters, one JSON line per reporter is streamed back
+    url(r'^correlation/(?P<ds_id>.+)/batch/$', views.dataset_correlation_batch,
+        name='dataset correlation batch'),
+    url(r'^correlation/matrix-cache/$', views.dataset_matrix_cache_stats,
+        name='dataset matrix cache stats'),
     url(r'^correlation/(?P<ds_id>.+)/$', views.dataset_correlation_usable,
         name='dataset correlation usable test'),
     url(r'^factors/(?P<ds_id>.+)/$', views.dataset_factors,
@@ -25,6 +25,13 @@ class ComplexEncoder(JSONEncoder):
             return obj.strftime('%Y-%m-%d')
         if hasattr(obj, 'isoformat'):
             return obj.isoformat()
+        if hasattr(obj, 'dtype'):
+            # numpy arrays and scalars, e.g. packed dataset rows
+            if obj.ndim == 0:
+                return obj.item()
+            if obj.dtype.kind == 'f':
+                return to_float_list(obj)
+            return obj.tolist()
         return json.JSONEncoder.default(self, obj)
 
     def jsonBack(self, json):
@@ -34,6 +41,18 @@ class ComplexEncoder(JSONEncoder):
             return deserialize('json', '[' + json + ']')
 
 
+def to_float_list(values):
+    """
+        convert a row of numpy values to a list of python floats, float32
+        values are converted by their shortest repr so 12.3 stays 12.3
+    """
+    if hasattr(values, 'dtype'):
+        if values.dtype.itemsize < 8:
+            values = values.astype(str).astype(float)
+        return values.tolist()
+    return [float(v) for v in values]
+
+
 class GENERAL_ERRORS:
     """
         define some common errors
@@ -1,28 +1,41 @@
 # -*-coding: utf-8 -*-
 from __future__ import print_function
 import sys
-import os.path
 from django.db.models.aggregates import Count
 if sys.version > '3':
     PY3 = True
 else:
     PY3 = False
+import calendar
 import csv
+from collections import OrderedDict
+import hashlib
+from io import StringIO
 from django.conf import settings
+from django.core.cache import cache
 from django.views.decorators.http import require_http_methods
 from dataset import models
-from django.http.response import HttpResponse
+from django.http.response import HttpResponse, HttpResponseNotModified, \
+    StreamingHttpResponse
+from django.utils.http import http_date
 from django.views.decorators.csrf import csrf_exempt
 import json
-import shelve
+import logging
+import threading
+import time
 import requests
 import math
-from operator import itemgetter
 from tagging.models import Tag, TaggedItem
-from dataset.util import general_json_response, GENERAL_ERRORS
-import mygene
+from dataset.util import general_json_response, GENERAL_ERRORS, to_float_list
 from django.core.exceptions import ObjectDoesNotExist
 from .util import ComplexEncoder
+from .matrix import matrix_cache
+from .charts import chart_cache, chart_key, chart_renderer, render_png, \
+    render_svg, ChartBusy
+from .factors import FactorGroups, factor_layout, get_ds_factors, \
+    get_sample_name_list
+from .genes import gene_index, gene_mirna, gene_docs, reporters_from_doc, \
+    reporter_annotations, query_reporter_genes, platform_reporters
 
 
 def to_int(s):
@@ -32,7 +45,17 @@ def to_int(s):
         return s
 
 
-def adopt_dataset(ds_id):
+# fields adopt_dataset leaves out per profile; Django loads (and decodes)
+# a deferred field on first access, should a view need it after all
+DATASET_PROFILES = {
+    'full': (),
+    # views that never read the (large) metadata and factors JSON
+    'light': ('metadata', 'factors'),
+}
+
+
+def adopt_dataset(ds_id, profile='full'):
+    qs = models.BiogpsDataset.objects.defer(*DATASET_PROFILES[profile])
     try:
         ds_id = int(ds_id)
         is_pk = True
@@ -42,38 +65,17 @@ def adopt_dataset(ds_id):
     #    return None    # exclude balwin dataset for now
     try:
         if is_pk:
-            return models.BiogpsDataset.objects.get(pk=ds_id)
+            return qs.get(pk=ds_id)
         else:
-            return models.BiogpsDataset.objects.get(geo_gse_id=ds_id)
+            return qs.get(geo_gse_id=ds_id)
     except ObjectDoesNotExist:
         return None
 
 
-def get_sample_name_list(ds, from_factor=None):
-    names = []
-    for f in ds.metadata['factors']:
-        if from_factor is not None:
-            if from_factor in f[list(f)[0]]['factorvalue']:
-                name = f[list(f)[0]]['factorvalue'][from_factor]
-            else:
-                return []
-        else:
-            name = list(f)[0]
-        names.append(name)
-    return names
-
-
-def _get_ds_factors(ds):
-    """
-        return factors in the order of ds.factors, ds.metadata['factors'] or []
-    """
-    # set to ds.factors if provided
-    factors = ds.factors or []
-    # otherwise, taking from ds.metadata if factorvalue is provided
-    if not factors and 'factors' in ds.metadata:
-        if 'factorvalue' in list(ds.metadata['factors'][0].values())[0]:
-            factors = [list(e.values())[0]['factorvalue'] for e in ds.metadata['factors']]
-    return factors
+# computed factor layouts, keyed on dataset version and layout options
+FACTOR_LAYOUT_CACHE_SIZE = 256
+_factor_layouts = OrderedDict()
+_factor_layouts_lock = threading.Lock()
 
 
 def get_ds_factors_keys(ds, group=None, collapse=False, naming=None):
@@ -81,66 +83,21 @@ def get_ds_factors_keys(ds, group=None, collapse=False, naming=None):
         return an array of samples' info(factor value,
          name, display order, color order)
     """
-    factors = []
-    names = []
-    # tag = []
-    fvs = []
-    if group is not None:
-        # for j, f in enumerate(ds.factors):
-        for j, f in enumerate(_get_ds_factors(ds)):
-            order_idx = color_idx = None
-            # exception!
-            if group not in f:
-                return None
-            v = f[group]
-            if v not in fvs:
-                fvs.append(v)
-            color_idx = fvs.index(v)
-            if collapse:
-                # label(name) switch does not support when collapse is true
-                names.append(v)
-            # set order just factor value, do real order at the end
-            order_idx = v
-            factors.append({'order_idx': order_idx, 'color_idx': color_idx})
-    else:
-        # no group, order by sequence or preset 'order_idx'
-        i = 1
-        for f in ds.metadata['factors']:
-            content = f[list(f)[0]]
-            if 'order_idx' in content and 'color_idx' in content:
-                order_idx = content['order_idx']
-                color_idx = content['color_idx']
-            # finally by index number
-            else:
-                color_idx = order_idx = i
-                i = i + 1
-            factors.append({'order_idx': order_idx, 'color_idx': color_idx})
-
-    if len(names) == 0:
-        names = get_sample_name_list(ds, naming)
-
-    for j, e in enumerate(factors):
-        e['name'] = names[j]
-
-    # sort samples by grouped name
-    if group:
-        fvs.sort()
-        t = {}
-        interval = len(ds.metadata['factors'])
-        for e in factors:
-            val = e['order_idx']
-            idx = fvs.index(val)
-            od = interval*idx
-            if not collapse:
-                if val in t:
-                    t[val] += 1
-                    inc = t[val]
-                else:
-                    inc = t[val] = 0
-                od += inc
-            e['order_idx'] = od
-
-    return factors
+    key = (ds.id, ds.lastmodified, group, collapse, naming)
+    with _factor_layouts_lock:
+        factors = _factor_layouts.pop(key, None)
+        if factors is not None:
+            _factor_layouts[key] = factors
+    if factors is None:
+        factors = factor_layout(ds, group, collapse, naming)
+        with _factor_layouts_lock:
+            _factor_layouts[key] = factors
+            while len(_factor_layouts) > FACTOR_LAYOUT_CACHE_SIZE:
+                _factor_layouts.popitem(last=False)
+    if factors is False:
+        return None
+    # callers may modify the sample dicts
+    return [dict(e) for e in factors]
 
 
 def _contruct_meta(ds):
@@ -187,14 +144,14 @@ def dataset_list(request):
         qs = qs.order_by('created')
     count = qs.count()
     total_page = int(math.ceil(float(count) / float(page_by)))
+    datasets = list(qs[(page-1)*page_by: page*page_by])
+    tags = models.dataset_tags(datasets)
     ret = [{'id': ds.id, 'name': ds.name, 'slug': ds.slug,
             'geo_gse_id': ds.geo_gse_id, 'species': ds.species,
             'sample_count': ds.sample_count,
             'factor_count': ds.factor_count,
-            "tags": list(Tag.objects.get_for_object(ds).values_list
-                         ("name", flat=True))
-            } for ds in
-           qs[(page-1)*page_by: page*page_by]]
+            "tags": tags[ds.id]
+            } for ds in datasets]
 #     ds = qs.values_list('id', 'name', 'slug',
 #                         'summary')[(page-1)*page_by: page*page_by]
     return general_json_response(detail={"current_page": page,
@@ -224,58 +181,20 @@ def dataset_info(request, ds_id):
     return general_json_response(detail=ret)
 
 
-def _get_flat_list(a_list):
-    out_list = []
-    for val in a_list:
-        if isinstance(val, list):
-            out_list += val
-        else:
-            out_list.append(val)
-    return out_list
-
-
-def alwayslist(value, tuple_as_single=False):
-    if value is None:
-        return []
-    if (tuple_as_single and isinstance(value, list)) or \
-       (not tuple_as_single and isinstance(value, (list, tuple))):
-        return value
-    else:
-        return [value]
-
-
 def _get_reporter_from_gene(gene, with_taxid=False):
-    mg = mygene.MyGeneInfo()
-    # these are the fields reporters are taken from
-    rep_fields = ['entrezgene', 'reporter', 'refseq.rna', 'ensembl.gene']
-    _fields = rep_fields + ['taxid'] if with_taxid else rep_fields
-    data_json = mg.getgene(gene, fields=_fields) or {}
-    reporters = []
-    for field in rep_fields:
-        field = field.split('.')[0]
-        if field in data_json:
-            _rep = data_json[field]
-            if field in ['reporter', 'refseq', 'ensembl']:
-                # these are nested field
-                if isinstance(_rep, list):
-                    _rep = [list(x.values()) for x in _rep]
-                else:
-                    _rep = list(_rep.values())
-                _rep = _get_flat_list(_rep)
-                if field == 'refseq':
-                    _rep = [x.split('.')[0] for x in _rep]
-            reporters.append(_rep)
-    reporters = [str(x) for x in _get_flat_list(reporters)]
+    # the local gene index answers first, mygene.info for genes it misses
+    indexed = gene_index.lookup(gene)
+    if indexed is not None:
+        reporters, taxid = indexed
+    else:
+        data_json = gene_docs.get(gene) or {}
+        reporters = reporters_from_doc(data_json)
+        taxid = data_json['taxid'] if with_taxid else None
 
     # temporarily add miRNA reporters via flat file; remove when miRNA reporters are directly
     # returned by mygene.info
-    g2mirna_file = '/opt/biogps/gene2mirna_20170404.db'
-    if os.path.exists(g2mirna_file):
-        d = shelve.open(g2mirna_file, 'r')
-        if str(gene) in d:
-            reporters += alwayslist(d[str(gene)])
-        d.close()
-    return (reporters, data_json['taxid']) if with_taxid else reporters
+    reporters += gene_mirna.get(gene)
+    return (reporters, taxid) if with_taxid else reporters
 
 
 def get_dataset_data(ds, gene_id=None, reporter_id=None):
@@ -291,92 +210,44 @@ def get_dataset_data(ds, gene_id=None, reporter_id=None):
         reporters.append(reporter_id)
     else:
         return None
+    # most datasets of a mixed-platform search can't have the gene at all
+    if not platform_reporters.may_contain(ds, reporters):
+        return {'id': ds.id, 'name': ds.name, 'data': []}
     dd = ds.dataset_data.filter(reporter__in=reporters)
     data_list = []
     for d in dd:
-        data_list.append({d.reporter: {'values': d.data}})
+        data_list.append({d.reporter: {'values': d.values}})
     return {'id': ds.id, 'name': ds.name, 'data': data_list}
 
 
-def _avg_with_deviation(li):
-    average = round(float(sum(li)) / len(li), 2)
-    t = 0
-    for e in li:
-        total = t + (e - average) ** 2
-    dev = round(math.sqrt(float(total) / len(li)), 3)
-    return (average, dev)
-
-
 def prepare_chart_data(val_list, factors):
     """
         combine value and sample info together, grouping, collapse
         by order_index
     """
-    import copy
-    factors = copy.deepcopy(factors)
-    # combine values and samples, just by position in the array
-    for idx, e in enumerate(factors):
-        e['value'] = val_list[idx]
-    factors.sort(key=lambda e: e['order_idx'], reverse=True)
-    res = [factors[0]]
-    for e in factors[1:]:
-        # a new ordered element
-        if e['order_idx'] != res[-1]['order_idx']:
-            # last element is 'list-value' element
-            if type(res[-1]['value']) is list:
-                ad = _avg_with_deviation(res[-1]['value'])
-                res[-1]['dev'] = ad[1]
-                res[-1]['value'] = ad[0]
-            else:
-                res[-1]['dev'] = 0
-            res.append(e)
-        # same ordered element, put value to last element together
-        else:
-            # already have same ordered element
-            last_value = res[-1]['value']
-            if type(last_value) is list:
-                last_value.append(e['value'])
-            else:
-                res[-1]['value'] = [last_value, e['value']]
-    # last element in res
-    if type(res[-1]['value']) is list:
-        ad = _avg_with_deviation(res[-1]['value'])
-        res[-1]['dev'] = ad[1]
-        res[-1]['value'] = ad[0]
-    else:
-        res[-1]['dev'] = 0
-    for e in res:
-        # remove ' 1' surfix in element name only for samples starting with GSM, to match the biogps view
-        if e['name'].startswith('GSM'):
-            e['name'] = e['name'].rstrip(' 1')
-        else:
-            e['name'] = e['name'].rstrip(' ')
-    return res
+    return FactorGroups(factors).chart_rows([val_list])[0]
 
 
-def find_round(v):
-    r = math.pow(10, round(math.log(v, 10))*-1+3)
-    return 10 if r < 10 else r
+CHART_FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
 
 
-def draw_median(ax, pos, length, label):
-    ax.plot([pos, pos], [0, length], '#960096', linewidth=0.5)
-    ax.text(pos, length, label, ha='center', va='bottom',
-            fontsize=7, color='#960096')
+def _chart_response(content, content_type, etag, ds):
+    response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(
+        calendar.timegm(ds.lastmodified.utctimetuple()))
+    return response
 
 
 def dataset_chart(request, ds_id, reporter_id):
     """
-        return a static bar chart for this ds on this reporter
+        return a static bar chart for this ds on this reporter, a PNG or
+        with format=svg an SVG
     """
     ds = adopt_dataset(ds_id)
     if ds is None:
         return general_json_response(GENERAL_ERRORS.ERROR_NOT_FOUND,
                                      "dataset with this id not found.")
-    data_list = get_dataset_data(
-        ds, reporter_id=reporter_id)['data'][0][reporter_id]['values']
-    val_list = [float(item) for item in data_list]
-
     group = request.GET.get('group', None)
     collapse = request.GET.get('collapse', 'off')
     if collapse == 'on':
@@ -384,78 +255,41 @@ def dataset_chart(request, ds_id, reporter_id):
     else:
         collapse = False
     name = request.GET.get('name', None)
-
-    factors = get_ds_factors_keys(ds, group, collapse, name)
-    back = prepare_chart_data(val_list, factors)
-
-    # start render part
-    import numpy as np
-    color_total = len(settings.BAR_COLORS)
-    vals, devs, colors, val_dev = [], [], [], []
-    for idx, e in enumerate(back):
-        vals.append(e['value'])
-        devs.append(e['dev'])
-        if e['value'] >= 0:
-            val_dev.append(e['value']+e['dev'])
-        else:
-            val_dev.append(e['value']-e['dev'])
-        colors.append(settings.BAR_COLORS[e['color_idx'] % color_total])
-
-    y_pos = np.arange(len(back))
-    import matplotlib.pyplot as plt
-    fig, ax = plt.subplots()
-    fig.set_size_inches(15, len(back) * 0.14)
-    # draw bars
-    # bar width
-    width = 0.8
-    # only positive error bar
-    d_n = []
-    d_p = []
-    for idx, e in enumerate(vals):
-        if e > 0:
-            d_n.append(0)
-            d_p.append(devs[idx])
+    fmt = request.GET.get('format', 'png')
+    if fmt not in CHART_FORMATS:
+        return general_json_response(
+            GENERAL_ERRORS.ERROR_BAD_ARGS,
+            "format must be one of %s." % ', '.join(CHART_FORMATS))
+    content_type = CHART_FORMATS[fmt]
+
+    # a chart only changes with the dataset, see chart_key
+    key = chart_key(ds, reporter_id, group, collapse, name, fmt)
+    etag = '"%s"' % key
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    content = chart_cache.get(key, '.' + fmt)
+    if content is None:
+        data_list = get_dataset_data(
+            ds, reporter_id=reporter_id)['data'][0][reporter_id]['values']
+        val_list = to_float_list(data_list)
+        factors = get_ds_factors_keys(ds, group, collapse, name)
+        back = prepare_chart_data(val_list, factors)
+        if fmt == 'svg':
+            # quick enough to write in the request
+            content = render_svg(back)
         else:
-            d_p.append(0)
-            d_n.append(devs[idx])
-    ax.barh(y_pos, vals, width, color=colors, edgecolor='none',
-            xerr=[d_n, d_p], ecolor='#D2691E')
-    # eliminate top padding
-    plt.axis('tight')
-    # x axis range, have some padding space, and take standard dev into account
-    li = [max(val_dev), 0, min(val_dev)]
-    plt.xlim([min(li)*1.1, max(li)*1.1])
-
-    # x=0, draw y axis
-    ax.plot([0, 0], [0, len(back)], 'k', linewidth=0.5)
-    # draw median line and label
-    # M
-    median = np.median(vals)
-    rd = find_round(max(vals))
-    draw_median(ax, round(median*rd)/rd, len(back),
-                'M(%s)' % str(round(median*rd)/rd))
-    li = [max(vals), min(vals)]
-    # try Mx3
-    if median*3 < max(li) and median*3 > min(li):
-        draw_median(ax, round(median*3*rd)/rd, len(back), '3xM')
-    # try Mx10
-    if median*10 < max(li) and median*10 > min(li):
-        draw_median(ax, round(median*10*rd)/rd, len(back), '10xM')
-    # set ticks attributes
-    plt.tick_params(axis='x', which='both', bottom='off', top='off',
-                    labelsize=8)
-    plt.tick_params(axis='y', which='both', left='on', right='off',
-                    direction='out')
-    # draw y ticks and label
-    ax.set_yticks(y_pos + width / 2)
-    ax.set_yticklabels([e['name'] for e in back], fontsize=8)
-    # grid on x axis
-    plt.gca().xaxis.grid(linestyle='-', color='#aaaaaa')
-
-    response = HttpResponse(content_type='image/png')
-    fig.savefig(response, format='png', facecolor='w',
-                bbox_inches='tight', pad_inches=0.2)
-    return response
+            try:
+                content = chart_renderer.render(render_png, back)
+            except ChartBusy as e:
+                response = general_json_response(
+                    GENERAL_ERRORS.ERROR_INTERNAL, str(e))
+                response.status_code = 503
+                response['Retry-After'] = '1'
+                return response
+        chart_cache.put(key, content, '.' + fmt)
+    return _chart_response(content, content_type, etag, ds)
 
 
 def _es_search(rpt, q=None, dft=False, start=0, size=8, taxid=None):
@@ -773,7 +607,7 @@ def dataset_data(request, ds_id, gene_id):
     """
         get information about a dataset
     """
-    ds = adopt_dataset(ds_id)
+    ds = adopt_dataset(ds_id, profile='light')
     if ds is None:
         return general_json_response(detail='dataset with this id not found')
     ret = get_dataset_data(ds, gene_id=gene_id)
@@ -788,23 +622,59 @@ def dataset_full_data(request, ds_id, gene_id):
         return general_json_response(
             GENERAL_ERRORS.ERROR_BAD_ARGS,
             "Dataset with this id does not exist.")
-    data_lists = get_dataset_data(ds, gene_id=gene_id)['data']
     group = request.GET.get('group', None)
     collapse = request.GET.get('collapse', 'off')
     collapse = True if collapse == 'on' else False
     naming = request.GET.get('name', None)
     factors = get_ds_factors_keys(ds, group, collapse, naming)
-    res = {}
-    for e in data_lists:
-        r = list(e)[0]
-        vals = [float(item) for item in e[r]['values']]
-        back = prepare_chart_data(vals, factors)
-        res[r] = back
+    res = None
+    if collapse and group is not None and factors is not None:
+        res = _stored_chart_data(ds, gene_id, group, factors)
+    if res is None:
+        data_lists = get_dataset_data(ds, gene_id=gene_id)['data']
+        res = {}
+        if data_lists:
+            # all reporters of the gene aggregated at once
+            reps = [list(e)[0] for e in data_lists]
+            rows = [to_float_list(e[r]['values'])
+                    for e, r in zip(data_lists, reps)]
+            res = dict(zip(reps, FactorGroups(factors).chart_rows(rows)))
     ret = _contruct_meta(ds)
     ret.update({'faceted_values': res})
     return general_json_response(detail=ret)
 
 
+def _stored_chart_data(ds, gene_id, group, factors):
+    """
+        collapsed chart data of the gene's reporters, read from the group
+        means and stds stored with the dataset matrix; None if there are
+        none for this version of the dataset
+    """
+    try:
+        # only matrices in this host's store have them, don't decode others
+        # for nothing
+        if not models.BiogpsDatasetMatrix.objects\
+                .defer('_matrix', 'reporters').get(dataset=ds).has_file():
+            return None
+        mat = matrix_cache.get(ds)
+    except (models.BiogpsDatasetMatrix.DoesNotExist, IOError, OSError,
+            ValueError) as e:
+        # computed live from the dataset data instead
+        logging.warning('no stored chart data of dataset %s: %s', ds.id, e)
+        return None
+    fg = FactorGroups(factors)
+    if group not in mat.groups or \
+       mat.groups[group][0].shape[1] != len(fg.counts):
+        return None
+    means, stds = mat.groups[group]
+    res = {}
+    for rep in _get_reporter_from_gene(gene_id):
+        row = mat.row_of(rep)
+        if row is not None:
+            res[rep] = fg.chart_data(means[row], stds[row])
+    return res
+
+
 def _get_default_ds(gene_id, species=None):
     """
     Get a valid default dataset id for the given gene.
@@ -813,8 +683,7 @@ def _get_default_ds(gene_id, species=None):
     return None if no valid dataset id found.
     """
     if not species:
-        mg = mygene.MyGeneInfo()
-        data_json = mg.getgene(gene_id, fields='taxid')
+        data_json = gene_docs.get(gene_id)
         if data_json is None or 'taxid' not in data_json:
             return
         species = data_json['taxid']
@@ -881,7 +750,7 @@ def _get_default_ds(gene_id, species=None):
 
     if ds_id:
         #now double-check to make sure this dataset contains data in BiogpsDatasetData model
-        ds = adopt_dataset(ds_id)
+        ds = adopt_dataset(ds_id, profile='light')
         if ds:
             ret = get_dataset_data(ds, gene_id=gene_id)
             if ret["data"]:
@@ -894,14 +763,22 @@ def dataset_default(request):
     if gene_id is None:
         gene_id = settings.DEFAULT_GENE_ID
 
-    mg = mygene.MyGeneInfo()
-    data_json = mg.getgene(gene_id, fields='taxid')
-    if data_json is None or 'taxid' not in data_json:
-        return general_json_response(
-            GENERAL_ERRORS.ERROR_BAD_ARGS, "Gene id: %s may be invalid." % gene_id)
-    species = data_json['taxid']
+    # precomputed by build_ds_defaults, resolved live for genes it misses
+    # only the two columns, not the (large) dataset row
+    default = models.BiogpsDatasetGeneDefault.objects\
+        .filter(gene_id=str(gene_id))\
+        .values_list('taxid', 'dataset__geo_gse_id').first()
+    if default is not None:
+        # geo_gse_id is None if no dataset has data for the gene
+        species, default_ds_id = default
+    else:
+        data_json = gene_docs.get(gene_id)
+        if data_json is None or 'taxid' not in data_json:
+            return general_json_response(
+                GENERAL_ERRORS.ERROR_BAD_ARGS, "Gene id: %s may be invalid." % gene_id)
+        species = data_json['taxid']
 
-    default_ds_id = _get_default_ds(gene_id, species=species)
+        default_ds_id = _get_default_ds(gene_id, species=species)
     if 1:  # default_ds_id:   ### a temp fix to always return gene/taxid even dataset is None
         return general_json_response(detail={'gene': to_int(gene_id),
                                              'dataset': default_ds_id,
@@ -910,118 +787,355 @@ def dataset_default(request):
         return general_json_response(
             GENERAL_ERRORS.ERROR_BAD_ARGS, "Cannot get default dataset with gene id: %s. Check settings file for correct default datasets" % gene_id)
 
-def calc_correlation(rep, mat, min_corr, species=None):
-    import numpy as np
+CORRELATION_METHODS = ('pearson', 'spearman')
+
 
-    def pearsonr(v, m):
-        # Pearson correlation calculation taken from NumPy's implementation
-        v_m = v.mean()
-        m_m = m.mean(axis=1)
-        r_num = ((v - v_m) * (m.transpose() - m_m).transpose()).sum(axis=1)
-        r_den = np.sqrt(((v - v_m) ** 2).sum() *
-                        (((m.transpose() - m_m).transpose()) ** 2).sum(axis=1))
-        r = r_num / r_den
-        return r
-
-    rep_pos = mat.reporters.index(rep)
-    # Pearson correlations for provided reporter
-    if PY3:
-        from io import BytesIO
-        s = BytesIO(mat.matrix)
+def _parse_top(top):
+    """ top as a positive int, None if not given; ValueError otherwise """
+    if top is None:
+        return None
+    top = int(top)
+    if top <= 0:
+        raise ValueError('top must be positive')
+    return top
+
+
+def _select_correlated(corrs, min_corr, top=None):
+    """
+        (indices, values) of corrs above min_corr, only the top best of them
+        if top is given; unordered
+    """
+    import numpy as np
+    if top is not None and top < len(corrs):
+        # k best in linear time, unordered; NaNs are partitioned last
+        idx_corrs = np.argpartition(-corrs, top - 1)[:top]
+        idx_corrs = idx_corrs[corrs.take(idx_corrs) > min_corr]
     else:
-        from StringIO import StringIO
-        s = StringIO(mat.matrix)
-    matrix_data = np.load(s)
-    rep_vector = matrix_data[rep_pos]
-    corrs = pearsonr(rep_vector, matrix_data)
-    # Get indices of sufficiently correlated reporters
-    min_corr = float(min_corr)
-    idx_corrs = np.where(corrs > min_corr)[0]
-    # Get values for those indices
-    val_corrs = corrs.take(idx_corrs).tolist()
+        idx_corrs = np.where(corrs > min_corr)[0]
+    return idx_corrs, corrs.take(idx_corrs)
+
+
+def _annotate_reporters(reporters, species=None, platform_id=None):
+    """
+        gene ids and symbols of reporters, return
+        {reporter: [(gene_id, symbol), ...]}. taken from the platform's
+        annotation table, mygene is only queried for reporters not in it
+    """
+    anno = {}
+    missing = []
+    platform_anno = reporter_annotations.get(platform_id) \
+        if platform_id is not None else {}
+    for rep in reporters:
+        genes = platform_anno.get(rep.lower())
+        if genes is None:
+            missing.append(rep)
+        else:
+            anno[rep] = genes
+    anno.update(query_reporter_genes(missing, species=species))
+    return anno
+
+
+def _correlation_result(mat, idx_corrs, val_corrs, anno):
     # Return highest correlated first
-    corrs = list(zip(val_corrs, idx_corrs))
+    corrs = list(zip(val_corrs.tolist(), idx_corrs))
     corrs.sort(reverse=True)
-    rep_cor = {mat.reporters[i[1]]: i[0] for i in corrs}
-    # query mygene to get symbol from reporter
-    mg = mygene.MyGeneInfo()
-    species = species or 'human,mouse,rat,pig'
-    res = mg.querymany(list(rep_cor), scopes='reporter, entrezgene, ensembl.gene', fields='symbol', species=species)
     result = []
-    for i in res:
-        if 'notfound' in i:
-            gene_id, symbol = '', ''
-        else:
-            gene_id, symbol = i['_id'], i.get('symbol', '')
-        result.append({'id': gene_id, 'reporter': i['query'],
-                       'symbol': symbol, 'value':
-                       round(rep_cor[i['query']], 4)})
-    result = sorted(result, key=itemgetter('value'), reverse=True)
+    for value, i in corrs:
+        rep = mat.reporters[i]
+        for gene_id, symbol in anno.get(rep, [('', '')]):
+            result.append({'id': gene_id, 'reporter': rep,
+                           'symbol': symbol, 'value': round(value, 4)})
     return result
 
 
+def calc_correlation(rep, mat, min_corr, species=None, top=None,
+                     stats=None, method='pearson', platform_id=None):
+    """
+        reporters of mat correlated to rep above min_corr, highest first,
+        annotated with gene id and symbol (from the annotation table of
+        platform_id, if given). if top is given, only the top best are
+        kept, before sorting and annotation. if a stats dict is given,
+        'peak_bytes' of the correlation is recorded in it. method is one
+        of CORRELATION_METHODS
+    """
+    rep_pos = mat.row_of(rep)
+    min_corr = float(min_corr)
+    peak = 0
+    # served from the precomputed (Pearson) neighbour table when it has
+    # the answer
+    nbrs = None
+    if method == 'pearson':
+        nbrs = mat.neighbours(rep_pos, min_corr, top)
+    if nbrs is None:
+        # correlations for provided reporter, blockwise over the
+        # normalised matrix
+        corrs, peak = mat.correlate([rep_pos], method=method)
+        nbrs = _select_correlated(corrs[0], min_corr, top)
+    if stats is not None:
+        stats['peak_bytes'] = peak
+    idx_corrs, val_corrs = nbrs
+    anno = _annotate_reporters([mat.reporters[i] for i in idx_corrs],
+                               species=species, platform_id=platform_id)
+    return _correlation_result(mat, idx_corrs, val_corrs, anno)
+
+
+def calc_correlations(reps, mat, min_corr, species=None, top=None,
+                      stats=None, method='pearson', platform_id=None):
+    """
+        like calc_correlation for several reporters, yield (rep, result),
+        result is None if rep is not in mat. correlations of a block of
+        reporters come from one matrix-matrix product, and are annotated
+        together
+    """
+    if stats is not None:
+        stats['peak_bytes'] = 0
+    min_corr = float(min_corr)
+    n_rows = len(mat.reporters)
+    block = max(1, settings.MATRIX_BLOCK_BYTES // (4 * n_rows))
+    for start in range(0, len(reps), block):
+        chunk = [(rep, mat.row_of(rep)) for rep in reps[start:start + block]]
+        selected = {}
+        live = []
+        for rep, row in chunk:
+            if row is None:
+                continue
+            nbrs = None
+            if method == 'pearson':
+                nbrs = mat.neighbours(row, min_corr, top)
+            if nbrs is None:
+                live.append(row)
+            else:
+                selected[row] = nbrs
+        if live:
+            corrs, peak = mat.correlate(live, method=method)
+            if stats is not None:
+                stats['peak_bytes'] = max(stats['peak_bytes'], peak)
+            for row, row_corrs in zip(live, corrs):
+                selected[row] = _select_correlated(row_corrs, min_corr, top)
+        to_annotate = set()
+        for idx_corrs, _ in selected.values():
+            to_annotate.update(mat.reporters[i] for i in idx_corrs)
+        anno = _annotate_reporters(list(to_annotate), species=species,
+                                   platform_id=platform_id)
+        for rep, row in chunk:
+            if row is None:
+                yield rep, None
+            else:
+                idx_corrs, val_corrs = selected[row]
+                yield rep, _correlation_result(mat, idx_corrs, val_corrs,
+                                               anno)
+
+
+def _log_correlation_usage(ds, t0, stats, response=None):
+    """ log latency and peak memory of a correlation request """
+    elapsed = (time.time() - t0) * 1000
+    logging.info('correlation of dataset %s: %.1f ms, peak %d bytes',
+                 ds.id, elapsed, stats.get('peak_bytes', 0))
+    if response is not None:
+        response['X-Correlation-Time'] = '%.1f' % elapsed
+        response['X-Correlation-Peak-Bytes'] = str(stats.get('peak_bytes', 0))
+    return response
+
+
+def _too_large_for_correlation(ds):
+    """
+        True if ds has more than MAX_SAMPLE_4_CORRELATION samples and its
+        matrix would be decoded whole from the DB, not memory-mapped from
+        this host's matrix store. raise DoesNotExist if it has no matrix
+    """
+    if ds.sample_count <= settings.MAX_SAMPLE_4_CORRELATION:
+        return False
+    mat = models.BiogpsDatasetMatrix.objects.defer('_matrix', 'reporters')\
+        .get(dataset=ds)
+    return not mat.has_file()
+
+
 def dataset_correlation_usable(request, ds_id):
-    ds = adopt_dataset(ds_id)
-    if ds.sample_count > settings.MAX_SAMPLE_4_CORRELATION:
-        return general_json_response(
-            GENERAL_ERRORS.ERROR_INTERNAL, {'sample_count': ds.sample_count})
+    ds = adopt_dataset(ds_id, profile='light')
     try:
-        models.BiogpsDatasetMatrix.objects.get(dataset=ds)
+        too_large = _too_large_for_correlation(ds)
     except models.BiogpsDatasetMatrix.DoesNotExist:
         return general_json_response(
             GENERAL_ERRORS.ERROR_NOT_FOUND, {'sample_count': ds.sample_count})
+    if too_large:
+        return general_json_response(
+            GENERAL_ERRORS.ERROR_INTERNAL, {'sample_count': ds.sample_count})
     return general_json_response(detail={'sample_count': ds.sample_count})
 
 
+def _correlation_cache_key(ds, reporter_id, min_corr, top, method, ret_type):
+    raw = '|'.join(str(e) for e in (ds.id, ds.lastmodified.isoformat(),
+                                    reporter_id, min_corr, top, method,
+                                    ret_type))
+    # hashed, reporter ids may hold characters memcached keys can't
+    return 'correlation:' + hashlib.md5(raw.encode('utf-8')).hexdigest()
+
+
+def _cache_get(key):
+    """ cache.get, None if the cache backend fails (it is only a shortcut) """
+    try:
+        return cache.get(key)
+    except Exception as e:
+        logging.warning('cache get failed: %s', e)
+        return None
+
+
+def _cache_set(key, value, timeout):
+    try:
+        cache.set(key, value, timeout)
+    except Exception as e:
+        logging.warning('cache set failed: %s', e)
+
+
+def _correlation_response(ds, content, ret_type):
+    if ret_type is None:
+        return HttpResponse(content, content_type="application/json")
+    response = HttpResponse(content, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s.csv' \
+        % ds.geo_gse_id
+    return response
+
+
 def dataset_correlation(request, ds_id, reporter_id, min_corr):
     """Return NumPy correlation matrix for provided ID, reporter,
        and correlation coefficient
     """
-    ds = adopt_dataset(ds_id)
-    if ds.sample_count > settings.MAX_SAMPLE_4_CORRELATION:
+    ds = adopt_dataset(ds_id, profile='light')
+    try:
+        min_corr = float(min_corr)
+        top = _parse_top(request.GET.get('top', None))
+    except ValueError:
         return general_json_response(
-            GENERAL_ERRORS.ERROR_INTERNAL, "This dataset contains too many\
-             samples (%s) for us to compute pair-wise correlations, \
-             so we disabled this feature \
-             for this dataset." % ds.sample_count)
+            GENERAL_ERRORS.ERROR_BAD_ARGS,
+            "min must be a number and top a positive integer.")
+    method = request.GET.get('method', 'pearson')
+    if method not in CORRELATION_METHODS:
+        return general_json_response(
+            GENERAL_ERRORS.ERROR_BAD_ARGS,
+            "method must be one of %s." % ', '.join(CORRELATION_METHODS))
+    ret_type = request.GET.get('type', None)
+
+    # repeated requests are served from the shared cache, lastmodified in
+    # the key retires entries once the dataset is reloaded
+    cache_key = _correlation_cache_key(ds, reporter_id, min_corr, top,
+                                       method, ret_type)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return _correlation_response(ds, *cached)
+
     try:
-        _matrix = models.BiogpsDatasetMatrix.objects.get(dataset=ds)
+        if _too_large_for_correlation(ds):
+            return general_json_response(
+                GENERAL_ERRORS.ERROR_INTERNAL, "This dataset contains too many\
+                 samples (%s) for us to compute pair-wise correlations, \
+                 so we disabled this feature \
+                 for this dataset." % ds.sample_count)
+        _matrix = matrix_cache.get(ds)
     except models.BiogpsDatasetMatrix.DoesNotExist:
         return general_json_response(
             GENERAL_ERRORS.ERROR_NOT_FOUND, "Cannot\
              get matrix of dataset: %s." % ds_id)
 
     # Get position of reporter
-    if reporter_id in _matrix.reporters:
+    if reporter_id in _matrix:
         species = getattr(ds, 'species', None)
-        result = calc_correlation(reporter_id, _matrix, min_corr, species=species)
-        ret_type = request.GET.get('type', None)
+        t0 = time.time()
+        stats = {}
+        result = calc_correlation(reporter_id, _matrix, min_corr,
+                                  species=species, top=top, stats=stats,
+                                  method=method, platform_id=ds.platform_id)
         if ret_type is None:
-            return HttpResponse(json.dumps(result, cls=ComplexEncoder),
-                                content_type="application/json")
+            content = json.dumps(result, cls=ComplexEncoder)
         else:
-            response = HttpResponse(content_type='text/csv')
-            response['Content-Disposition'] = 'attachment; filename=%s.csv' \
-                % ds.geo_gse_id
-            writer = csv.writer(response)
+            out = StringIO()
+            writer = csv.writer(out)
             writer.writerow(list(result[0]))
             i = 0
             while(i < len(result)):
                 writer.writerow(list(result[i].values()))
                 i = i + 1
-            return response
+            content = out.getvalue()
+        _cache_set(cache_key, (content, ret_type),
+                   settings.CORRELATION_CACHE_TIMEOUT)
+        response = _correlation_response(ds, content, ret_type)
+        return _log_correlation_usage(ds, t0, stats, response)
 
     return general_json_response(
         GENERAL_ERRORS.ERROR_BAD_ARGS, "Reporter %s not\
         in dataset: %s." % (reporter_id, ds_id))
 
 
+@csrf_exempt
+@require_http_methods(["POST"])
+def dataset_correlation_batch(request, ds_id):
+    """
+        correlations of many reporters in one request. POST a JSON body
+        {"reporters": [...], "min_corr": 0.9, "top": 50, "method": "pearson"},
+        "top" and "method" optional. results stream back as one JSON line
+        per reporter
+    """
+    try:
+        body = json.loads(request.body.decode('utf-8'))
+        reporters = [str(r) for r in body['reporters']]
+        min_corr = float(body['min_corr'])
+        top = _parse_top(body.get('top', None))
+        method = body.get('method', 'pearson')
+        if method not in CORRELATION_METHODS:
+            raise ValueError('unknown method')
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return general_json_response(
+            GENERAL_ERRORS.ERROR_BAD_ARGS, 'POST body must be JSON with a\
+             "reporters" list, "min_corr" and optionally "top" and "method".')
+    ds = adopt_dataset(ds_id, profile='light')
+    if ds is None:
+        return general_json_response(GENERAL_ERRORS.ERROR_NOT_FOUND,
+                                     "dataset with this id not found")
+    try:
+        if _too_large_for_correlation(ds):
+            return general_json_response(
+                GENERAL_ERRORS.ERROR_INTERNAL, "This dataset contains too many\
+                 samples (%s) for us to compute pair-wise correlations, \
+                 so we disabled this feature \
+                 for this dataset." % ds.sample_count)
+        _matrix = matrix_cache.get(ds)
+    except models.BiogpsDatasetMatrix.DoesNotExist:
+        return general_json_response(
+            GENERAL_ERRORS.ERROR_NOT_FOUND, "Cannot\
+             get matrix of dataset: %s." % ds_id)
+
+    species = getattr(ds, 'species', None)
+
+    def stream():
+        t0 = time.time()
+        stats = {}
+        for rep, result in calc_correlations(reporters, _matrix, min_corr,
+                                             species=species, top=top,
+                                             stats=stats, method=method,
+                                             platform_id=ds.platform_id):
+            if result is None:
+                line = {'reporter': rep, 'error': 'not in dataset'}
+            else:
+                line = {'reporter': rep, 'results': result}
+            yield json.dumps(line, cls=ComplexEncoder) + '\n'
+        # headers are gone by now, the batch is only logged
+        _log_correlation_usage(ds, t0, stats)
+    return StreamingHttpResponse(stream(),
+                                 content_type='application/x-ndjson')
+
+
+def dataset_matrix_cache_stats(request):
+    """
+        hit/miss/eviction counters of this worker's matrix cache
+    """
+    return general_json_response(detail=matrix_cache.stats())
+
+
 def dataset_factors(request, ds_id):
     ds = adopt_dataset(ds_id)
     if ds is None:
         return general_json_response(GENERAL_ERRORS.ERROR_NOT_FOUND,
                                      "dataset with this id not found")
-    ds_factors = _get_ds_factors(ds)
+    ds_factors = get_ds_factors(ds)
     # no factor value
     if ds.factor_count == 0 or ds_factors is None:
         return general_json_response(code=GENERAL_ERRORS.ERROR_NOT_FOUND)